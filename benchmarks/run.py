@@ -0,0 +1,238 @@
+"""Benchmarks of the scan, archive, copy and logging stages
+
+Builds synthetic projects from a fixed seed, times each stage on them and outputs the results as JSON.
+Run it from the setup folder:
+    python3 -m benchmarks.run -o before.json
+    python3 -m benchmarks.run -o after.json -c before.json -tl 0.2
+With --compare, the exit code is 1 if a stage got slower than the baseline beyond the tolerance.
+"""
+
+from benchmarks.trees import SHAPES, build_tree, tree_size
+import statistics
+import subprocess
+import platform
+import tempfile
+import shutil
+import click
+import json
+import time
+import sys
+import os
+
+RESULTS_VERSION = 1
+STAGES = ('scan', 'scan_approx', 'archive', 'copy', 'log')
+# Stages that don't depend on a project
+GLOBAL_STAGES = ('log',)
+LOG_MESSAGES = 50000
+
+
+def get_commit():
+    """
+    :return: The short hash of the current commit, or None outside of a git repository
+    """
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def measure(run, repeat, cleanup=None):
+    """Times a function several times
+    :param run: function to time, called without arguments
+    :param repeat: number of runs
+    :param cleanup: optional function called after each run, outside of the timing
+    :return: dictionary/object holding the median, the minimum and every run, in seconds
+    """
+    runs = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run()
+        runs.append(time.perf_counter() - started)
+        if cleanup:
+            cleanup()
+    return {'median': statistics.median(runs), 'min': min(runs), 'runs': runs}
+
+
+def bench_project(main, proj_fld, work_fld, stages, repeat):
+    """Times the stages of a backup on a project
+    :param main: the main module of shlerp
+    :param proj_fld: text, the project folder
+    :param work_fld: text, an empty folder receiving the backups
+    :param stages: list of the stages to time
+    :param repeat: number of runs of each stage
+    :return: dictionary/object holding the results of each stage, and the rules detected by the exact and the
+    approximate scans if they have been run
+    """
+    settings = main.get_settings()
+    approximate = settings['scan']['approximate']
+    options = {
+        'noexcl': False,
+        'nogit': False,
+        'keephidden': False,
+        'gitignore': False,
+        'compresslevel': settings['compression']['level'],
+        'format': 'zip',
+        'incremental': False,
+        'dedup': False,
+        'snapshot': False
+    }
+    detected = {'rules': main.auto_detect(proj_fld, rescan=True)}
+    results = {}
+    agreement = None
+
+    def scan():
+        # The detection cache is bypassed, the full scan is measured
+        detected['rules'] = main.auto_detect(proj_fld, rescan=True)
+
+    def scan_approx():
+        approximate['enabled'] = True
+        try:
+            detected['approximate'] = main.auto_detect(proj_fld, rescan=True)
+        finally:
+            approximate['enabled'] = False
+
+    def archive():
+        main.make_archive(proj_fld, f'{work_fld}/archive', detected['rules'], options, main.state('uid'), time.time(), '')
+
+    def copy():
+        main.duplicate(proj_fld, f'{work_fld}/copy', detected['rules'], options, main.state('uid'), time.time(), '')
+
+    if 'scan' in stages:
+        results['scan'] = measure(scan, repeat)
+    if 'scan_approx' in stages:
+        results['scan_approx'] = measure(scan_approx, repeat)
+        agreement = {
+            'exact': sorted(_rule['name'] for _rule in detected['rules']),
+            'approximate': sorted(_rule['name'] for _rule in detected['approximate'])
+        }
+        agreement['agree'] = agreement['exact'] == agreement['approximate']
+    if 'archive' in stages:
+        results['archive'] = measure(archive, repeat, lambda: os.remove(f'{work_fld}/archive.zip'))
+    if 'copy' in stages:
+        results['copy'] = measure(copy, repeat, lambda: shutil.rmtree(f'{work_fld}/copy'))
+    if main.state('failures'):
+        raise click.ClickException(f'Backup failures: {main.state("failures")}')
+    return results, agreement
+
+
+def bench_log(utils, repeat):
+    """Times the logging of LOG_MESSAGES lines, until they are written"""
+    def run():
+        for i in range(LOG_MESSAGES):
+            utils.log(f'[bench:{utils.get_dt()}:arch][I] Added: src/file_{i}.js', 'exec')
+        utils.flush_logs()
+    return measure(run, repeat)
+
+
+def compare(results, baseline, tolerance, min_delta):
+    """Compares the results with a baseline
+    :param results: dictionary/object holding the results of the current run
+    :param baseline: dictionary/object holding the results of a previous run
+    :param tolerance: number, the slowdown allowed, relative to the baseline (0.2 = 20%)
+    :param min_delta: number, slowdowns shorter than this many seconds are considered as noise
+    :return: the list of the stages that got slower
+    """
+    regressions = []
+    click.echo(f'\n{"Stage":<24}{"Baseline":>12}{"Current":>12}{"Change":>10}')
+    for stage, current in results['stages'].items():
+        if stage not in baseline['stages']:
+            continue
+        before = baseline['stages'][stage]['median']
+        after = current['median']
+        change = (after - before) / before if before else 0
+        slower = after > before * (1 + tolerance) and after - before > min_delta
+        if slower:
+            regressions.append(stage)
+        click.echo(
+            f'{stage:<24}{before:>11.3f}s{after:>11.3f}s{change:>+10.0%}' + (' REGRESSION' if slower else '')
+        )
+    return regressions
+
+
+@click.command()
+@click.option('-o', '--output', type=click.Path(), help='File receiving the results as JSON. Printed if not set')
+@click.option('-c', '--compare', 'baseline_path', type=click.Path(exists=True), help='Results of a previous run to compare with')
+@click.option('-tl', '--tolerance', default=0.2, type=click.FloatRange(min=0), help='Slowdown allowed by --compare, relative to the baseline. Defaults to 0.2 (20%)')
+@click.option('-md', '--min-delta', default=0.01, type=click.FloatRange(min=0), help='Slowdowns shorter than this many seconds are ignored by --compare. Defaults to 0.01')
+@click.option('-s', '--shape', 'shapes', multiple=True, type=click.Choice(list(SHAPES)), help='Project shape to benchmark, can be repeated. Defaults to all of them')
+@click.option('-st', '--stage', 'stages', multiple=True, type=click.Choice(STAGES), help='Stage to benchmark, can be repeated. Defaults to all of them')
+@click.option('-r', '--repeat', default=3, type=click.IntRange(min=1), help='Number of runs of each stage, the median is kept. Defaults to 3')
+@click.option('--seed', default=0, type=int, help='Seed of the synthetic projects. Defaults to 0')
+@click.option('--scale', default=1, type=click.IntRange(min=1), help='Multiplies the size of the synthetic projects. Defaults to 1')
+@click.option('-w', '--workdir', type=click.Path(file_okay=False), help='Folder where the projects are built, they are reused by the next runs. Temporary if not set')
+def run(output, baseline_path, tolerance, min_delta, shapes, stages, repeat, seed, scale, workdir):
+    """Benchmarks shlerp on synthetic projects"""
+    shapes = shapes or tuple(SHAPES)
+    stages = stages or STAGES
+    temp_fld = tempfile.mkdtemp(prefix='shlerp-bench-')
+    # The logs of the benchmark are written into the temporary folder, not into the user ones
+    os.environ['HOME'] = temp_fld
+    # Imported once HOME is set, along with the settings
+    import main
+    from tools import utils
+    main.activate_headless()
+    main.set_state('uid', 'bench')
+    main.set_state('total', 1)
+
+    results = {
+        'version': RESULTS_VERSION,
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': seed,
+        'scale': scale,
+        'repeat': repeat,
+        'trees': {},
+        'stages': {},
+        'agreement': {}
+    }
+    try:
+        for shape in shapes:
+            if not set(stages) - set(GLOBAL_STAGES):
+                break
+            proj_fld = f'{workdir or temp_fld}/{shape}-{seed}-{scale}'
+            if not os.path.isdir(proj_fld):
+                click.echo(f'Building {shape}...', err=True)
+                build_tree(shape, proj_fld, seed, scale)
+            files, size = tree_size(proj_fld)
+            results['trees'][shape] = {'files': files, 'bytes': size}
+
+            click.echo(f'Benchmarking {shape}...', err=True)
+            work_fld = tempfile.mkdtemp(dir=temp_fld)
+            stage_results, agreement = bench_project(main, proj_fld, work_fld, stages, repeat)
+            for stage, result in stage_results.items():
+                results['stages'][f'{shape}.{stage}'] = result
+            if agreement:
+                results['agreement'][shape] = agreement
+        if 'log' in stages:
+            click.echo('Benchmarking log...', err=True)
+            results['stages']['log'] = bench_log(utils, repeat)
+    finally:
+        shutil.rmtree(temp_fld, ignore_errors=True)
+
+    if results['agreement']:
+        agreeing = [shape for shape, agreement in results['agreement'].items() if agreement['agree']]
+        click.echo(f'Approximate scan agrees with the exact scan on {len(agreeing)}/{len(results["agreement"])} project(s)', err=True)
+    if output:
+        with open(output, 'w') as write_results:
+            write_results.write(json.dumps(results, indent=4))
+    else:
+        click.echo(json.dumps(results, indent=4))
+
+    if baseline_path:
+        with open(baseline_path, 'r') as read_baseline:
+            baseline = json.load(read_baseline)
+        if baseline.get('seed') != seed or baseline.get('scale') != scale:
+            click.echo('Warning: the baseline has been measured on different projects (seed or scale)', err=True)
+        regressions = compare(results, baseline, tolerance, min_delta)
+        if regressions:
+            click.echo(f'\nRegressions beyond {tolerance:.0%}: {", ".join(regressions)}', err=True)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,141 @@
+###############################################################
+# This file features the synthetic projects used by the
+# benchmarks. Each shape is built from a fixed seed, so that two
+# runs (or two commits) measure exactly the same tree.
+
+import random
+import os
+
+WORDS = (
+    'const', 'return', 'import', 'function', 'value', 'self', 'data', 'list', 'index', 'result', 'error', 'module',
+    'export', 'default', 'string', 'number', 'config', 'build', 'test', 'client', 'server', 'request', 'response'
+)
+
+
+def _text(rng, size):
+    """
+    :return: text of about size bytes, made of lines of words
+    """
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word if rng.random() > 0.1 else f'{word}\n')
+        length += len(word) + 1
+    return ' '.join(words)
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb' if isinstance(content, bytes) else 'w') as write_file:
+        write_file.write(content)
+
+
+def _large_text(rng, size):
+    """
+    :return: text of size bytes, made of random slices of a smaller text, as generating every word would be slow
+    """
+    base = _text(rng, 256 * 1024)
+    pieces = []
+    for _ in range(size // 4096 + 1):
+        start = rng.randrange(len(base) - 4096)
+        pieces.append(base[start:start + 4096])
+    return ''.join(pieces)[:size]
+
+
+def _node_package(rng, root, depth):
+    """Writes a npm package, with its own nested node_modules down to a given depth"""
+    _write(f'{root}/package.json', '{"name": "%s", "version": "1.0.0"}' % os.path.basename(root))
+    for i in range(rng.randint(5, 15)):
+        _write(f'{root}/lib/file_{i}.js', _text(rng, rng.randint(200, 4000)))
+    if depth > 0:
+        for i in range(3):
+            _node_package(rng, f'{root}/node_modules/dep_{depth}_{i}', depth - 1)
+
+
+def build_node_modules(root, rng, scale=1):
+    """A small NodeJS project holding a large and deep node_modules folder"""
+    _write(f'{root}/package.json', '{"name": "app", "dependencies": {}}')
+    _write(f'{root}/package-lock.json', '{"lockfileVersion": 3}')
+    for i in range(20):
+        _write(f'{root}/src/component_{i}.js', _text(rng, rng.randint(500, 3000)))
+    for i in range(20 * scale):
+        _node_package(rng, f'{root}/node_modules/package_{i}', 3)
+
+
+def build_small_files(root, rng, scale=1):
+    """A Python project made of thousands of small files"""
+    _write(f'{root}/requirements.txt', 'click\nrequests\n')
+    _write(f'{root}/setup.py', 'from setuptools import setup\nsetup()\n')
+    for i in range(5000 * scale):
+        _write(f'{root}/package/module_{i // 100}/file_{i}.py', _text(rng, rng.randint(100, 2000)))
+
+
+def build_binaries(root, rng, scale=1):
+    """A Go project holding a few huge binaries: random ones, which don't compress, and a compressible one"""
+    _write(f'{root}/go.mod', 'module example.com/app\n\ngo 1.22\n')
+    _write(f'{root}/main.go', 'package main\n\nfunc main() {}\n')
+    for i in range(3):
+        _write(f'{root}/assets/blob_{i}.bin', rng.randbytes(32 * 1024 * 1024 * scale))
+    _write(f'{root}/assets/dump.sql', _large_text(rng, 32 * 1024 * 1024 * scale))
+
+
+def build_monorepo(root, rng, scale=1):
+    """A monorepo mixing a NodeJS front-end, a Python back-end with its virtual environment, and a Go service"""
+    _write(f'{root}/README.md', _text(rng, 2000))
+    _write(f'{root}/frontend/package.json', '{"name": "frontend"}')
+    for i in range(200 * scale):
+        _write(f'{root}/frontend/src/view_{i}.ts', _text(rng, rng.randint(500, 5000)))
+    for i in range(10 * scale):
+        _node_package(rng, f'{root}/frontend/node_modules/package_{i}', 2)
+    _write(f'{root}/backend/requirements.txt', 'django\n')
+    for i in range(300 * scale):
+        _write(f'{root}/backend/app/module_{i}.py', _text(rng, rng.randint(500, 5000)))
+    for i in range(500 * scale):
+        _write(f'{root}/backend/venv/lib/site-packages/lib_{i // 50}/file_{i}.py', _text(rng, rng.randint(500, 5000)))
+    _write(f'{root}/service/go.mod', 'module example.com/service\n')
+    for i in range(100 * scale):
+        _write(f'{root}/service/pkg/file_{i}.go', _text(rng, rng.randint(500, 5000)))
+
+
+def build_wide(root, rng, scale=1):
+    """A large Python project with some JavaScript, holding a very wide folder of generated files"""
+    _write(f'{root}/requirements.txt', 'flask\n')
+    for i in range(40000 * scale):
+        extension = '.py' if rng.random() < 0.8 else rng.choice(('.js', '.json', '.md'))
+        _write(f'{root}/src/package_{i // 500}/file_{i}{extension}', _text(rng, rng.randint(50, 500)))
+    for i in range(20000 * scale):
+        _write(f'{root}/generated/item_{i}.py', _text(rng, rng.randint(50, 200)))
+
+
+SHAPES = {
+    'node_modules': build_node_modules,
+    'small_files': build_small_files,
+    'binaries': build_binaries,
+    'monorepo': build_monorepo,
+    'wide': build_wide
+}
+
+
+def build_tree(shape, root, seed=0, scale=1):
+    """Builds a synthetic project
+    :param shape: text, one of the SHAPES
+    :param root: text, the folder to build the project into. Must not exist
+    :param seed: number, the seed of the random generator
+    :param scale: number multiplying the size of the project
+    :return: the number of files and the number of bytes of the project
+    """
+    os.makedirs(root)
+    SHAPES[shape](root, random.Random(seed), scale)
+    return tree_size(root)
+
+
+def tree_size(root):
+    """
+    :return: the number of files and the number of bytes of a folder
+    """
+    files = size = 0
+    for folder, _, names in os.walk(root):
+        files += len(names)
+        size += sum(os.path.getsize(f'{folder}/{name}') for name in names)
+    return files, size
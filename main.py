@@ -11,29 +11,48 @@ from tools.state import (
     set_state,
     append_state,
     incr_state,
+    record_stage,
+    get_metrics,
     get_printed,
     force_verbose,
     activate_headless
 )
 from tools.utils import (
+    ARCHIVE_FORMATS,
     get_app_details,
     get_setup_fld,
     is_archive,
-    get_settings
+    get_settings,
+    profile_startup
 )
 from tools.piputils import (
     print_term,
+    start_progress,
+    update_progress,
+    end_progress,
+    run_buffered,
     upload_archive,
+    upload_spool,
+    MAX_UPLOAD_SIZE,
     time_until_expiry,
 )
 from tools.scan import (
+    get_rule_index,
+    get_fingerprint,
+    get_cached_detection,
+    store_detection,
+    walk_project,
     frameworks_processing,
     vanilla_processing
 )
+from tools.exclusions import (
+    compile_exclusions,
+    walk
+)
 from tools import utils
 from os.path import exists
 from signal import signal, SIGINT
-from zipfile import ZipFile, ZIP_DEFLATED
+from stat import S_ISDIR
 import threading
 import re
 import os
@@ -45,10 +64,12 @@ import json
 
 # Main logic & functions
 
-def auto_detect(proj_fld):
+def auto_detect(proj_fld, rescan=False):
     """Auto-detects the project language/framework
     to then back it up while applying the exclusions defined in the rule that
     matched for this particular language/framework
+    :param proj_fld: text, the project folder
+    :param rescan: if True, the rules detected during a previous run are not reused
     :return: dictionary/object representing the rule/language corresponding to the project
     """
     v_leads = []
@@ -59,8 +80,8 @@ def auto_detect(proj_fld):
 
     # Step 1: Get the rules from the config & temporary file
     try:
-        with open(f'{get_setup_fld()}/config/rules.json', 'r') as read_file:
-            rules = json.load(read_file)
+        rules = utils.get_rules()
+        rule_index = get_rule_index()
     except FileNotFoundError:
         print_term('scan', 'E', 'rules.json not found', )
         exit(1)
@@ -82,113 +103,179 @@ def auto_detect(proj_fld):
         print_term('scan', 'I', 'Temp file not found, will use the whole ruleset instead', )
         tmp_file = {'frameworks': [], 'vanilla': []}
         tmp_fld = f'{get_setup_fld()}/tmp'
-        if not exists(tmp_fld):
-            os.mkdir(tmp_fld)
+        os.makedirs(tmp_fld, exist_ok=True)
         with open(f'{tmp_fld}/rules_history.json', 'w') as write_tmp:
             write_tmp.write(json.dumps(tmp_file, indent=4))
 
-    # Step 2: Evaluate rules from the frameworks section
+    # Step 2: Reuse the rules detected during a previous run if the project didn't change since then
+    fingerprint = get_fingerprint(rules, proj_fld, rule_index)
+    if not rescan:
+        cached = get_cached_detection(rules, proj_fld, fingerprint)
+        if cached:
+            print_term('scan', 'I', 'Project unchanged since the previous scan, reusing the detected rules', )
+            record_stage(proj_fld, 'scan', time.time() - started)
+            return cached
+
+    # Step 3: Walk the project once, this feeds both the framework criteria and the extension counters
+    scores = walk_project(rules, proj_fld, rule_index)
+
+    # Step 4: Evaluate rules from the frameworks section
     print_term('scan', 'I', 'Evaluating framework rules...', )
-    fw_leads = frameworks_processing(rules, proj_fld)
+    fw_leads = frameworks_processing(rules, proj_fld, scores)
 
-    # Step 3: Evaluate vanilla rules if the frameworks didn't match anything
+    # Step 5: Evaluate vanilla rules if the frameworks didn't match anything
     print_term('scan', 'I', 'Evaluating vanilla rules...', )
-    v_leads = vanilla_processing(rules, proj_fld, )
+    v_leads = vanilla_processing(rules, proj_fld, scores)
 
-    # Step 4: Exit the function
+    # Step 6: Cache the detected rules, then exit the function
+    if fw_leads or v_leads:
+        store_detection(rules, proj_fld, fingerprint, fw_leads + v_leads)
     elapsed_time = time.time() - started  # Calculate elapsed time
+    # A failed detection counts as an error of the scan
+    record_stage(proj_fld, 'scan', elapsed_time, scores['files'], errors=0 if fw_leads or v_leads else 1)
     if state('debug'): print_term('scan:stat', 'D', f'Auto-detection completed in {elapsed_time:.2f} seconds')
     return fw_leads + v_leads
 
 
-def make_archive(proj_fld, dst_path, rules, options, uid, started, count):
+def make_archive(proj_fld, dst_path, rules, options, uid, started, count, spool=None):
     """
-    Creates a zip archive of the project folder.
+    Creates an archive of the project folder, in the format selected by --format (zip by default).
     :param proj_fld: text, the folder we want to archive
-    :param dst_path: text, the location where we want to store the archive
+    :param dst_path: text, the location where we want to store the archive, without extension
     :param rules: list of dictionaries/objects representing the rules/languages corresponding to the project
-    :param options: dictionary/object containing exclusion options
+    :param options: dictionary/object containing exclusion & archive options
     :param uid: text representing a short uid
     :param started: number representing the time when the script has been executed
     :param count: string that represents nothing or the current count out of a total of backups to process
+    :param spool: optional, the spool returned by open_spool() when the archive is uploaded while it is written
     """
-    with ZipFile(f'{dst_path}.zip', 'w', ZIP_DEFLATED, compresslevel=9) as zip_archive:
-        fld_count = file_count = 0
-        success = True
-        if state('total') == 1:
-            count = ''
-        
-        #####################
-        # Exclusion zone
-
-        # Collect exclusions from all rules
-        exclusions = {
-            'files': set(),
-            'folders': set(),
-            'dep_folders': set()
-        }
-        exclusions['files'].add('.DS_Store')
-        for rule in rules:
-            if 'actions' in rule and 'exclude' in rule['actions']:
-                exclude = rule['actions']['exclude']
-                if 'files' in exclude:
-                    exclusions['files'].update(exclude['files'])
-                if 'folders' in exclude:
-                    exclusions['folders'].update(exclude['folders'])
-                if 'dep_folders' in exclude:
-                    exclusions['dep_folders'].update(exclude['dep_folders'])
-
-        for elem_path in utils.iglob_hidden(proj_fld + '/**', recursive=True):
-            rel_name = elem_path.split(f'{proj_fld}/')[1]
-            proceed = True
-            output = True
-
-            if options['nogit']:
-                exclusions['folders'].add('.git')
-                exclusions['files'].add('.gitignore')
-
-            # Reject the current relative path if one of these conditions are matched
-            if not options['noexcl']:
-                if any(dep_folder in elem_path for dep_folder in exclusions['dep_folders']):
-                    proceed = False
-                if any(excl in rel_name for excl in exclusions['folders']):
-                    proceed = False
-                if any(excl in rel_name for excl in exclusions['files']):
-                    proceed = False
-
-            if '.git' in elem_path:
-                output = False
-
-            #####################
-            # Archive making
-
-            if proceed:
-                if rel_name == '':
-                    output = False
-                try:
-                    zip_archive.write(elem_path, rel_name)
-                    if os.path.isdir(elem_path):
-                        rel_name = rel_name + '/'
-                        fld_count += 1
-                    else:
-                        file_count += 1
-                    if output:
-                        print_term('arch', 'I', f'Added: {rel_name}', uid, cnt=count)
-                except Exception as e:
-                    success = False
-                    print_term('arch', 'E', f'Error adding {rel_name}: {e}', uid, cnt=count)
-
-        if success:
-            append_state('backed_up', proj_fld)
-            print_term('stat', 'I', f'Folders: {fld_count} - Files: {file_count}', uid, cnt=count)
-            print_term('stat', 'I', f'✅ Project archived ({"%.2f" % (time.time() - started)}s): {dst_path}.zip', uid, cnt=count)
+    # The archive modules are only loaded by the runs that need them, they weigh on the startup of every command
+    from tools.archive import write_entries, write_tar_entries, get_store_check, open_tar
+    from tools.incremental import open_snapshot, select_changed, record_done, commit_snapshot
+    from tools.spool import publish
+    from zipfile import ZipFile, ZIP_DEFLATED
+    archive_path = f'{dst_path}{ARCHIVE_FORMATS[options["format"]]}'
+    compression = get_settings()['compression']
+    fld_count = file_count = errors = 0
+    success = True
+    stage_started = time.time()
+    if state('total') == 1:
+        count = ''
+
+    #####################
+    # Exclusion zone
+
+    matcher = compile_exclusions(rules, options)
+
+    def selected():
+        """Yields the paths to archive, along with their name within the archive.
+        Excluded folders are never entered, their content costs nothing"""
+        yield f'{proj_fld}/', ''
+        for elem_path, rel_name, is_dir in walk(proj_fld, matcher):
+            yield elem_path, rel_name
+
+    snapshot = None
+    entries = selected()
+    if options['incremental']:
+        # Only the files that changed since the previous snapshot are archived
+        snapshot = open_snapshot(proj_fld, dst_path, options['format'], get_settings()['incremental']['hash'])
+        entries = select_changed(snapshot, entries)
+
+    #####################
+    # Archive making
+
+    def written():
+        """Writes the selected paths into the archive, yields the outcome of each entry"""
+        if options['format'] == 'zip':
+            # Files are deflated by a pool of threads, the entries are still written in order
+            with ZipFile(archive_path, 'w', ZIP_DEFLATED, compresslevel=options['compresslevel']) as zip_archive:
+                yield from write_entries(
+                    zip_archive, entries,
+                    compresslevel=options['compresslevel'],
+                    workers=compression['workers'],
+                    should_store=get_store_check(compression['store']),
+                    trial=compression['trial'],
+                    on_commit=(lambda offset: publish(spool, offset)) if spool else None
+                )
         else:
-            append_state('failures', proj_fld)
-            print_term('stat', 'W', f'Incomplete archive: {dst_path}.zip', uid, cnt=count)
+            # Tar archives are streamed, the whole stream is compressed at once
+            with open_tar(
+                archive_path, options['format'],
+                level=options['compresslevel'],
+                xz_level=compression['xz_level'],
+                zstd_level=compression['zstd_level'],
+                workers=compression['workers']
+            ) as tar_archive:
+                yield from write_tar_entries(tar_archive, entries)
+
+    progress = start_progress('arch', uid, count)
+    try:
+        for elem_path, rel_name, error in written():
+            output = rel_name != '' and '.git' not in elem_path
+            if error is None:
+                try:
+                    elem_stat = os.stat(elem_path)
+                except OSError:
+                    elem_stat = None
+                if elem_stat and S_ISDIR(elem_stat.st_mode):
+                    rel_name = rel_name + '/'
+                    fld_count += 1
+                    update_progress(progress, f'Added: {rel_name}' if output else None, files=0)
+                else:
+                    file_count += 1
+                    if snapshot:
+                        record_done(snapshot, rel_name)
+                    update_progress(progress, f'Added: {rel_name}' if output else None, elem_stat.st_size if elem_stat else 0)
+            else:
+                success = False
+                errors += 1
+                print_term('arch', 'E', f'Error adding {rel_name}: {error}', uid, cnt=count)
+    finally:
+        end_progress(progress)
+        if spool:
+            # The archive is complete once written() is exhausted, the uploader can send the rest of it
+            if success and sys.exc_info()[0] is None:
+                publish(spool, os.path.getsize(archive_path), done=True)
+            else:
+                publish(spool, failed=True)
+
+    record_stage(
+        proj_fld, 'archive', time.time() - stage_started, file_count, progress['bytes'],
+        os.path.getsize(archive_path) if exists(archive_path) else 0, errors
+    )
+
+    if snapshot:
+        # Files that failed are left out of the manifest, they will be archived again next time
+        commit_snapshot(snapshot)
+        print_term('stat', 'I', f'Changed: {len(snapshot["changed"])} - Deleted: {len(snapshot["manifest"]["snapshots"][-1]["deleted"])}', uid, cnt=count)
+
+    if success:
+        append_state('backed_up', proj_fld)
+        print_term('stat', 'I', f'Folders: {fld_count} - Files: {file_count}', uid, cnt=count)
+        print_term('stat', 'I', f'✅ Project archived ({"%.2f" % (time.time() - started)}s): {archive_path}', uid, cnt=count)
+    else:
+        append_state('failures', proj_fld)
+        print_term('stat', 'W', f'Incomplete archive: {archive_path}', uid, cnt=count)
+
+
+def list_files(proj_fld, rules, options, folders=None):
+    """Lists the files of a project, the excluded folders are never entered
+    :param proj_fld: text, the project folder
+    :param rules: list of dictionaries/object representing the technologies used by the project
+    :param options: dictionary/object containing exclusion options
+    :param folders: list that receives the folders met along the way, relative to the project folder
+    :return: yields (path, rel_name) tuples
+    """
+    for elem_path, rel_name, is_dir in walk(proj_fld, compile_exclusions(rules, options)):
+        if not is_dir:
+            yield elem_path, rel_name
+        elif folders is not None:
+            folders.append(rel_name)
 
 
 def duplicate(proj_fld, dst, rules, options, uid, started, count):
-    """Duplicates a project folder, processes all files and folders. node_modules will be processed last if cache = True
+    """Duplicates a project folder. The filtered tree is listed once, the folders are created
+    then the files are copied by a pool of threads
     :param proj_fld: string that represents the project folder we want to duplicate
     :param dst: string that represents the destination folder where we will copy the project files
     :param rules: list of dictionaries/object representing the technologies used by the project
@@ -197,43 +284,138 @@ def duplicate(proj_fld, dst, rules, options, uid, started, count):
     :param started: number representing the time when the script has been executed
     :param count: string that represents nothing or the current count out of a total of backups to process
     """
+    from tools.incremental import open_snapshot, select_changed, record_done, commit_snapshot
+    from tools.clone import find_previous_backup, get_cloner, copy_files
 
-    fld_count = file_count = 0
-    elem_list = utils.get_files(proj_fld, rules, options)
+    file_count = errors = written = 0
+    failed = False
+    stage_started = time.time()
     if state('total') == 1:
         count = ''
+    # In snapshot mode, files are reflinked, hardlinked against the previous backup or copied by the kernel
+    methods = {}
+    copy_file = shutil.copy2
+    if options['snapshot']:
+        copy_file = get_cloner(proj_fld, find_previous_backup(dst))
+
+    folders = []
+    copies = list_files(proj_fld, rules, options, folders)
+    snapshot = None
+    if options['incremental']:
+        # Only the files that changed since the previous snapshot are copied
+        snapshot = open_snapshot(proj_fld, dst, 'copy', get_settings()['incremental']['hash'])
+        copies = select_changed(snapshot, copies)
+    copies = [(orig, f'{dst}/{elem}', elem) for orig, elem in copies]
+
+    # Folders are created ahead of time. In incremental mode, only the ones holding changed files are needed
+    if snapshot:
+        folders = sorted({os.path.dirname(elem) for orig, full_dst, elem in copies} - {''})
     os.mkdir(dst)
-    for elem in elem_list:
-        orig = f'{proj_fld}/{elem}'
-        full_dst = f'{dst}/{elem}'
+    for folder in folders:
+        os.makedirs(f'{dst}/{folder}', exist_ok=True)
+
+    progress = start_progress('copy', uid, count, len(copies))
+    for (orig, full_dst, elem), method, error in copy_files(copies, copy_file, get_settings()['copy']['workers']):
         try:
-            if os.path.isdir(orig):
-                shutil.copytree(orig, full_dst)
-                if exists(full_dst):
-                    print_term('copy', 'I', f'Done: {proj_fld}/{elem}/', uid, cnt=count)
-                    fld_count += 1
-            else:
-                shutil.copy(orig, full_dst)
-                file_count += 1
-                if exists(full_dst):
-                    print_term('copy', 'I', f'Done: {proj_fld}/{elem}', uid, cnt=count)
+            if error:
+                raise error
+            file_count += 1
+            if options['snapshot']:
+                methods[method] = methods.get(method, 0) + 1
+            if snapshot:
+                record_done(snapshot, elem)
+            size = os.path.getsize(full_dst)
+            # Reflinked and hardlinked files don't write their data
+            if not options['snapshot'] or method == 'copy':
+                written += size
+            update_progress(progress, f'Done: {proj_fld}/{elem}', size)
         except FileNotFoundError as fnf_error:
             print_term('copy', 'E', f'File not found: {fnf_error}', uid, cnt=count)
-            append_state('failures', proj_fld)
+            failed = True
+            errors += 1
         except PermissionError as perm_error:
             print_term('copy', 'E', f'Permission error: {perm_error}', uid, cnt=count)
-            append_state('failures', proj_fld)
+            failed = True
+            errors += 1
         except shutil.Error as shutil_error:
             print_term('copy', 'E', f'Shutil error: {shutil_error}', uid, cnt=count)
-            append_state('failures', proj_fld)
+            failed = True
+            errors += 1
         except Exception as exc:
             print_term('copy', 'E', f'Unexpected error: {exc}', uid, cnt=count)
-            append_state('failures', proj_fld)
-
+            failed = True
+            errors += 1
+    end_progress(progress)
+    record_stage(proj_fld, 'copy', time.time() - stage_started, file_count, progress['bytes'], written, errors)
+    if failed:
+        append_state('failures', proj_fld)
+
+    # Folder metadata is copied last, as adding files into a folder changes its mtime
+    for folder in folders:
+        try:
+            shutil.copystat(f'{proj_fld}/{folder}', f'{dst}/{folder}')
+        except OSError:
+            pass
+
+    if snapshot:
+        commit_snapshot(snapshot)
+        print_term('stat', 'I', f'Changed: {len(snapshot["changed"])} - Deleted: {len(snapshot["manifest"]["snapshots"][-1]["deleted"])}', uid, cnt=count)
+    if options['snapshot']:
+        print_term('stat', 'I', f'Reflinked: {methods.get("reflink", 0)} - Hardlinked: {methods.get("hardlink", 0)} - Copied: {methods.get("copy", 0)}', uid, cnt=count)
+    print_term('stat', 'I', f'Folders: {len(folders)} - Files: {file_count}', uid, cnt=count)
     print_term('stat', 'I', f'✅ Project duplicated ({"%.2f" % (time.time() - started)}s): {dst}/', uid, cnt=count)
     append_state('backed_up', proj_fld)
 
 
+def dedup_backup(proj_fld, dst, rules, options, uid, started, count):
+    """Backs up a project into the content-addressed store. Only the chunks that aren't stored yet are written,
+    the backup itself is an index referencing the files it contains
+    :param proj_fld: string that represents the project folder we want to back up
+    :param dst: string that represents the backup destination, the index is named after it
+    :param rules: list of dictionaries/object representing the technologies used by the project
+    :param options: dictionary/object containing exclusion options
+    :param uid: text representing a short uid,
+    :param started: number representing the time when the script has been executed
+    :param count: string that represents nothing or the current count out of a total of backups to process
+    """
+    from tools.store import get_store_fld, store_file, write_snapshot
+    store_fld = get_store_fld(dst)
+    level = get_settings()['dedup']['compresslevel']
+    entries = []
+    total_size = written_size = errors = 0
+    success = True
+    stage_started = time.time()
+    if state('total') == 1:
+        count = ''
+
+    files = list(list_files(proj_fld, rules, options))
+    progress = start_progress('dedu', uid, count, len(files))
+    for orig, elem in files:
+        try:
+            stat = os.stat(orig)
+            digest, size, written = store_file(store_fld, orig, level)
+            entries.append([elem, digest, size, stat.st_mode & 0o777, stat.st_mtime_ns])
+            total_size += size
+            written_size += written
+            update_progress(progress, f'{"Stored" if written else "Known"}: {proj_fld}/{elem}', size)
+        except OSError as os_error:
+            success = False
+            errors += 1
+            print_term('dedu', 'E', f'Error storing {elem}: {os_error}', uid, cnt=count)
+    end_progress(progress)
+    record_stage(proj_fld, 'dedup', time.time() - stage_started, len(entries), total_size, written_size, errors)
+
+    # Files that failed are left out of the index
+    index_path = write_snapshot(store_fld, os.path.basename(dst), proj_fld, entries)
+    print_term('stat', 'I', f'Files: {len(entries)} - Size: {total_size / 1048576:.2f}MB - Written: {written_size / 1048576:.2f}MB', uid, cnt=count)
+    if success:
+        append_state('backed_up', proj_fld)
+        print_term('stat', 'I', f'✅ Project stored ({"%.2f" % (time.time() - started)}s): {index_path}', uid, cnt=count)
+    else:
+        append_state('failures', proj_fld)
+        print_term('stat', 'W', f'Incomplete backup: {index_path}', uid, cnt=count)
+
+
 def set_upload_expiration(ctx, param, value):
     """Callback to fetch default expiration from settings.json if `-u` is used without a value."""
     opt_origin = ctx.get_parameter_source(param.name)
@@ -249,6 +431,18 @@ def set_upload_expiration(ctx, param, value):
         return None
 
 
+def print_startup_profile(ctx, param, value):
+    """Callback of --startup-profile: measures the startup of shlerp --help then exits."""
+    if not value or ctx.resilient_parsing:
+        return
+    total, modules = profile_startup(['--help'])
+    click.echo(f'Startup time of shlerp --help: {total * 1000:.0f}ms')
+    click.echo('Import time of the modules loaded at startup (site is the startup of the interpreter):')
+    for name, seconds in modules:
+        click.echo(f'  {name:<30}{seconds * 1000:>8.1f}ms')
+    ctx.exit()
+
+
 def validate_path(ctx, param, value):
     """Custom validator to ensure the target exists."""
     if value:
@@ -273,18 +467,35 @@ def validate_path(ctx, param, value):
         return None
 
 
-@click.command(epilog=f'shlerp v{get_app_details()["proj_ver"]} - More details: https://github.com/synka777/shlerp-cmd')
-@click.option('-t', '--target', type=click.Path(), default=lambda: os.getcwd(), callback=validate_path, help=get_app_details()["options"]["target"])
-@click.option('-o', '--output', type=click.Path(), callback=validate_path, help=get_app_details()["options"]["output"])
-@click.option('-a', '--archive', default=False, is_flag=True, help=get_app_details()["options"]["archive"])
-@click.option('-u', '--upload', callback=set_upload_expiration, help=get_app_details()["options"]["upload"])
-@click.option('-r', '--rules', help=get_app_details()["options"]["rule"])
-@click.option('-b', '--batch', default=False, is_flag=True, help=get_app_details()["options"]["batch"])
-@click.option('-ne', '--noexcl', default=False, is_flag=True, help=get_app_details()["options"]["noexcl"])
-@click.option('-ng', '--nogit', default=False, is_flag=True, help=get_app_details()["options"]["nogit"])
-@click.option('-kh', '--keephidden', default=False, is_flag=True, help=get_app_details()["options"]["keephidden"])
-@click.option('-hl', '--headless', default=False, is_flag=True, help=get_app_details()["options"]["headless"])
-def main(target, output, archive, upload, rules, batch, noexcl, nogit, keephidden, headless):
+# The app details are read once, for all the options
+app_details = get_app_details()
+opt_help = app_details['options']
+
+
+@click.command(epilog=f'shlerp v{app_details["proj_ver"]} - More details: https://github.com/synka777/shlerp-cmd')
+@click.option('-t', '--target', type=click.Path(), default=lambda: os.getcwd(), callback=validate_path, help=opt_help["target"])
+@click.option('-o', '--output', type=click.Path(), callback=validate_path, help=opt_help["output"])
+@click.option('-a', '--archive', default=False, is_flag=True, help=opt_help["archive"])
+@click.option('-u', '--upload', callback=set_upload_expiration, help=opt_help["upload"])
+@click.option('-r', '--rules', help=opt_help["rule"])
+@click.option('-b', '--batch', default=False, is_flag=True, help=opt_help["batch"])
+@click.option('-ne', '--noexcl', default=False, is_flag=True, help=opt_help["noexcl"])
+@click.option('-ng', '--nogit', default=False, is_flag=True, help=opt_help["nogit"])
+@click.option('-kh', '--keephidden', default=False, is_flag=True, help=opt_help["keephidden"])
+@click.option('-hl', '--headless', default=False, is_flag=True, help=opt_help["headless"])
+@click.option('-j', '--jobs', default=1, type=click.IntRange(min=1), help=opt_help["jobs"])
+@click.option('-cl', '--compresslevel', type=click.IntRange(0, 9), help=opt_help["compresslevel"])
+@click.option('-f', '--format', 'archive_format', type=click.Choice(list(ARCHIVE_FORMATS)), help=opt_help["format"])
+@click.option('-i', '--incremental', default=False, is_flag=True, help=opt_help["incremental"])
+@click.option('-rs', '--restore', type=click.Path(exists=True), help=opt_help["restore"])
+@click.option('-dd', '--dedup', default=False, is_flag=True, help=opt_help["dedup"])
+@click.option('-sn', '--snapshot', default=False, is_flag=True, help=opt_help["snapshot"])
+@click.option('-gi', '--gitignore', default=False, is_flag=True, help=opt_help["gitignore"])
+@click.option('-rsc', '--rescan', default=False, is_flag=True, help=opt_help["rescan"])
+@click.option('-sj', '--stats-json', type=click.Path(dir_okay=False), help=opt_help["stats_json"])
+@click.option('-sp', '--stats-prom', type=click.Path(dir_okay=False), help=opt_help["stats_prom"])
+@click.option('--startup-profile', is_flag=True, expose_value=False, is_eager=True, callback=print_startup_profile, help=opt_help["startup_profile"])
+def main(target, output, archive, upload, rules, batch, noexcl, nogit, keephidden, headless, jobs, compresslevel, archive_format, incremental, restore, dedup, snapshot, gitignore, rescan, stats_json, stats_prom):
     """Dev projects backups made easy"""
 
     #####################
@@ -298,6 +509,12 @@ def main(target, output, archive, upload, rules, batch, noexcl, nogit, keephidde
         'noexcl': noexcl,
         'nogit': nogit,
         'keephidden': keephidden,
+        'gitignore': gitignore,
+        'compresslevel': compresslevel if compresslevel is not None else get_settings()['compression']['level'],
+        'format': archive_format or 'zip',
+        'incremental': incremental,
+        'dedup': dedup,
+        'snapshot': snapshot
     }
 
     #####################
@@ -340,6 +557,34 @@ def main(target, output, archive, upload, rules, batch, noexcl, nogit, keephidde
             print_term('prep', 'E', f'Missing value for --{path["opt"]}', )
             exit(0)
 
+    if restore:
+        from tools.incremental import restore_snapshot
+        from tools.store import restore_store_snapshot, is_store_snapshot
+        # Rebuild the project from the chain of incremental snapshots, up to the given backup
+        backup_path = os.path.abspath(restore).rstrip('/')
+        backup_name = os.path.basename(backup_path)
+        for ext in (*ARCHIVE_FORMATS.values(), '.json'):
+            if backup_name.endswith(ext):
+                backup_name = backup_name[:-len(ext)]
+        restore_fld = output['path'] if output else os.path.dirname(backup_path)
+        started = time.time()
+        if is_store_snapshot(backup_path):
+            # Indexes of --dedup backups reference the whole project, no chain to replay.
+            # By default the project is restored in the folder holding the store: {output}/.shlerp/store/snapshots
+            if not output:
+                restore_fld = os.path.dirname(os.path.dirname(os.path.dirname(restore_fld)))
+            restore_dst = f'{restore_fld}/{backup_name}_restored_{utils.get_dt()}'
+            restored = restore_store_snapshot(backup_path, restore_dst)
+            print_term('stat', 'I', f'✅ Project restored from the store, {restored} file(s) ({"%.2f" % (time.time() - started)}s): {restore_dst}/', )
+            exit(0)
+        restore_dst = f'{restore_fld}/{backup_name}_restored_{utils.get_dt()}'
+        replayed = restore_snapshot(backup_path, restore_dst)
+        if replayed:
+            print_term('stat', 'I', f'✅ Snapshot restored from {replayed} backup(s) ({"%.2f" % (time.time() - started)}s): {restore_dst}/', )
+        else:
+            print_term('prep', 'E', f'No incremental manifest references {backup_path}', )
+        exit(0)
+
     if batch:
         force_verbose()
     if batch and not output:
@@ -351,6 +596,22 @@ def main(target, output, archive, upload, rules, batch, noexcl, nogit, keephidde
             print_term('prep', 'I', 'Exiting shlerp', )
             exit(0)
 
+    if archive_format:
+        # Picking an archive format implies that we want an archive
+        archive = True
+        from tools.archive import zstd_available
+        if archive_format == 'tar.zst' and not zstd_available():
+            print_term('prep', 'E', 'The tar.zst format needs Python 3.14+ or the zstandard package', )
+            exit(0)
+
+    if dedup and (archive or upload or incremental):
+        print_term('prep', 'E', '--dedup can\'t be combined with --archive, --format, --upload or --incremental', )
+        exit(0)
+
+    if snapshot and (archive or upload or dedup):
+        print_term('prep', 'E', '--snapshot only applies to copies, it can\'t be combined with --archive, --format, --upload or --dedup', )
+        exit(0)
+
     is_upload = False
     if upload:
         try:
@@ -373,10 +634,29 @@ def main(target, output, archive, upload, rules, batch, noexcl, nogit, keephidde
         """
         batch_list = []
         if batch:
-            batch_list = [f'{target["path"]}/{f}' for f in os.listdir(target['path'])]
+            # Hidden folders are skipped, this includes the .shlerp folder holding the incremental manifests
+            batch_list = [f'{target["path"]}/{f}' for f in os.listdir(target['path']) if not f.startswith('.')]
         else:
             batch_list.append(target['path'])
 
+        def scan_elem(batch_elem):
+            print_term('scan', 'I', f'Scanning {batch_elem}', )
+            return auto_detect(batch_elem, rescan)
+
+        # Folders that need the automatic detection are scanned up front, concurrently if --jobs allows it
+        to_scan = [
+            batch_elem for batch_elem in batch_list
+            if os.path.isdir(batch_elem)
+            and not (len(kwargs) > 0 and kwargs['rules'])
+            and not batch_elem.startswith('.')
+        ]
+        if jobs > 1 and len(to_scan) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                detected = dict(zip(to_scan, pool.map(lambda elem: run_buffered(scan_elem, elem), to_scan)))
+        else:
+            detected = {batch_elem: scan_elem(batch_elem) for batch_elem in to_scan}
+
         for batch_elem in batch_list:
             elem_rules = None
             if os.path.isdir(batch_elem):
@@ -384,9 +664,7 @@ def main(target, output, archive, upload, rules, batch, noexcl, nogit, keephidde
                     # Get rules from the --rule option, separated by semi colons
                     elem_rules = [rule for rule in kwargs['rule'].lower().split(';')]
                 else:
-                    if not batch_elem.startswith('.'):
-                        print_term('scan', 'I', f'Scanning {batch_elem}', )
-                        elem_rules = auto_detect(batch_elem, )
+                    elem_rules = detected.get(batch_elem)
                 if elem_rules:
                     print_term('scan', 'I', f'Detected: {[rule["name"] for rule in elem_rules]}', )
                     backup_sources.append({
@@ -404,6 +682,105 @@ def main(target, output, archive, upload, rules, batch, noexcl, nogit, keephidde
                         'already_archived': True # already_archived will either be True, or non-existent at all
                     })
 
+    def process_backup(backup, count):
+        """Backs up a single project, then uploads it if --upload has been used
+        :param backup: dictionary/object representing the project to process
+        :param count: string that represents nothing or the current count out of a total of backups to process
+        """
+        start_time = time.time()
+        archiving_failed = False
+        upload_future = None
+        upload_started = None
+
+        if batch: # Used to display information
+            print_term('dedu' if dedup else 'arch' if archive else 'copy', 'I', f'Processing: {backup["proj_fld"]}', uid, cnt=count)
+
+        if dedup:
+            # Files are added to the content-addressed store, the backup is an index of references
+            dedup_backup(
+                backup['proj_fld'], backup['dst'],
+                backup['rules'], options,
+                uid, start_time, count
+            )
+        elif archive and not backup.get('already_archived'):
+            # If --archive is provided to the script, we use make_archive()
+            spool = None
+            if is_upload and get_settings()['upload_default']['pipeline']:
+                # The archive is uploaded while it is written, the upload ends shortly after the archive is complete
+                from tools.spool import open_spool
+                from concurrent.futures import ThreadPoolExecutor
+                spool = open_spool(f'{backup["dst"]}{ARCHIVE_FORMATS[options["format"]]}')
+                with ThreadPoolExecutor(max_workers=1) as upload_pool:
+                    upload_started = time.time()
+                    upload_future = upload_pool.submit(run_buffered, upload_spool, spool, expiration, MAX_UPLOAD_SIZE)
+                    make_archive(
+                        backup['proj_fld'], backup['dst'],
+                        backup['rules'], options,
+                        uid, start_time, count,
+                        spool
+                    )
+            else:
+                make_archive(
+                    backup['proj_fld'], backup['dst'],
+                    backup['rules'], options,
+                    uid, start_time, count
+                )
+        elif not archive:
+            # Else if we don't want an archive we will do a copy of the project instead
+            duplicate(
+                backup['proj_fld'], backup['dst'],
+                backup['rules'], options,
+                uid, start_time, count
+            )
+
+        if is_upload:
+            step = 'uplo'
+            zip_path = ''
+
+            # The zip file name has to be defined differently depending if the --target was already an archive or not
+            if backup.get('already_archived'):
+                zip_path = backup['dst']
+            elif backup['proj_fld'] in state('backed_up'):
+                zip_path = f'{backup["dst"]}{ARCHIVE_FORMATS[options["format"]]}'
+            else:
+                print_term(step, 'E', 'Archiving process failed - skipping upload', )
+                archiving_failed = True
+
+            if not archiving_failed:
+                response = None
+                uploaded = False
+                if upload_future:
+                    # The upload started along with the archive, the size limit has been checked while streaming
+                    response = upload_future.result()
+                else:
+                    archive_size_mb = utils.get_file_size(zip_path)
+                    archive_size_gb = archive_size_mb / 1024  # Convert MB to GB
+                    if archive_size_gb > 2:  # 2 GB limit
+                        print_term(step, 'E', f'File size is too big: {archive_size_gb:.2f} GB', )
+                    else:
+                        upload_started = time.time()
+                        response = upload_archive(zip_path, expiration)
+                        if response is None:
+                            append_state('upload_failures', backup['proj_fld'])
+
+                if upload_future and response is None:
+                    append_state('upload_failures', backup['proj_fld'])
+                elif response is not None:
+                    json_resp = response.json()
+                    if json_resp['success']:
+                        uploaded = True
+                        expiry_message = time_until_expiry(json_resp['expires'])
+                        print_term(step, 'I', f'🔗 Single use: {json_resp["link"]} - {expiry_message}', uid, cnt=count)
+                    else:
+                        append_state('upload_failures', backup['proj_fld'])
+                        print_term(step, 'E', f'Upload failed: {json_resp["error"]}', uid, cnt=count)
+                if upload_started:
+                    size = os.path.getsize(zip_path) if exists(zip_path) else 0
+                    record_stage(
+                        backup['proj_fld'], 'upload', time.time() - upload_started, 1, size, size if uploaded else 0,
+                        0 if uploaded else 1
+                    )
+
     ################################################
     # 1 - Check options validity & prepare mandatory
     #     variables for data processing
@@ -453,79 +830,56 @@ def main(target, output, archive, upload, rules, batch, noexcl, nogit, keephidde
     # 2 - Data processing, show progress 
     if not state('debug'):
         incr_state('total', len(backup_sources))
-        for backup in backup_sources:
-            start_time = time.time()
-            show_state = True if batch else False
-            count = ''
-            if show_state: # Used to display information
-                count = f'{(len(state("backed_up")) + len(state("failures"))) + 1}/{state("total")}'
-
-            if batch: # Used to display information
-                print_term('arch' if archive else 'copy', 'I', f'Processing: {backup["proj_fld"]}', uid, cnt=count)
-
-            if archive and not backup.get('already_archived'):
-                # If --archive is provided to the script, we use make_archive()
-                make_archive(
-                    backup['proj_fld'], backup['dst'],
-                    backup['rules'], options,
-                    uid, start_time, count
-                )
-            if not archive:
-                # Else if we don't want an archive we will do a copy of the project instead
-                duplicate(
-                    backup['proj_fld'], backup['dst'],
-                    backup['rules'], options,
-                    uid, start_time, count
-                )
-
-            if is_upload:
-                step = 'uplo'
-                zip_path = ''
-
-                # The zip file name has to be defined differently depending if the --target was already an archive or not
-                if backup.get('already_archived'):
-                    zip_path = backup['dst']
-                elif backup['proj_fld'] in state('backed_up'):
-                    zip_path = f'{backup["dst"]}.zip'
-                else:
-                    print_term(step, 'E', 'Archiving process failed - skipping upload', )
-                    archiving_failed = True
-
-                if not archiving_failed:
-                    archive_size_mb = utils.get_file_size(zip_path)
-                    archive_size_gb = archive_size_mb / 1024  # Convert MB to GB
-                    if archive_size_gb > 2:  # 2 GB limit
-                        print_term(step, 'E', f'File size is too big: {archive_size_gb:.2f} GB', )
-                    else:
-                        response = upload_archive(zip_path, expiration)
-                        json_resp = response.json()
-                        if json_resp['success']:
-                            expiry_message = time_until_expiry(json_resp['expires'])
-                            print_term(step, 'I', f'🔗 Single use: {json_resp["link"]} - {expiry_message}', uid, cnt=count)
-                        else:
-                            append_state('upload_failures', backup['proj_fld'])
-                            print_term(step, 'E', f'Upload failed: {json_resp["error"]}', uid, cnt=count)
-
-            if batch:  # Used to display information
-                failed_cnt = len(state('failures')) + len(state('ad_failures'))
-                backed_up_cnt = len(state('backed_up'))
-
-                # This condition is there to make sure we got through the whole list of projects
-                # before displaying the stats
-                if backed_up_cnt + failed_cnt == state('total'):
-                    step = 'stat'
-                    summary = f'Successful: {backed_up_cnt} - ' \
-                            f'Failed: {failed_cnt} - ' \
-                            f'Total runtime: {"%.2f" % (time.time() - exec_time)}s'
-                    # Display which kind of operation has been done during current execution
-                    operation = 'Upload' if upload else 'Archive' if archive else 'Copy'
-                    print_term(step, 'I', summary, )
-                    if len(state('ad_failures')) > 0:
-                        print_term(step, 'W', f'Detection failures: {state("ad_failures")}', )
-                    if len(state('failures')) > 0:
-                        print_term(step, 'W', operation, f'Backup failures: {state("failures")}', )
-                    if len(state('upload_failures')) > 0:
-                        print_term(step, 'W', f'Upload failures: {state("upload_failures")}', )
+        # Count strings are computed up front, as projects may complete in any order
+        counts = [
+            f'{position}/{state("total")}' if batch else ''
+            for position in range(1, len(backup_sources) + 1)
+        ]
+
+        if jobs > 1 and len(backup_sources) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            # Each worker holds back the output of its project, which is printed in one block once the project is done
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                futures = [
+                    pool.submit(run_buffered, process_backup, backup, count)
+                    for backup, count in zip(backup_sources, counts)
+                ]
+                for future in futures:
+                    future.result()
+        else:
+            for backup, count in zip(backup_sources, counts):
+                process_backup(backup, count)
+
+        if batch:  # Used to display information
+            failed_cnt = len(state('failures')) + len(state('ad_failures'))
+            backed_up_cnt = len(state('backed_up'))
+
+            # This condition is there to make sure we got through the whole list of projects
+            # before displaying the stats
+            if backed_up_cnt + failed_cnt == state('total'):
+                step = 'stat'
+                summary = f'Successful: {backed_up_cnt} - ' \
+                        f'Failed: {failed_cnt} - ' \
+                        f'Total runtime: {"%.2f" % (time.time() - exec_time)}s'
+                # Display which kind of operation has been done during current execution
+                operation = 'Upload' if upload else 'Dedup' if dedup else 'Archive' if archive else 'Copy'
+                print_term(step, 'I', summary, )
+                if len(state('ad_failures')) > 0:
+                    print_term(step, 'W', f'Detection failures: {state("ad_failures")}', )
+                if len(state('failures')) > 0:
+                    print_term(step, 'W', f'{operation} failures: {state("failures")}', )
+                if len(state('upload_failures')) > 0:
+                    print_term(step, 'W', f'Upload failures: {state("upload_failures")}', )
+
+        if stats_json or stats_prom:
+            from tools.metrics import build_stats, write_stats_json, write_prometheus
+            stats = build_stats(uid, exec_time, time.time() - exec_time, get_metrics())
+            for stats_path, write_stats in ((stats_json, write_stats_json), (stats_prom, write_prometheus)):
+                if stats_path:
+                    try:
+                        write_stats(os.path.abspath(stats_path), stats)
+                    except OSError as os_error:
+                        print_term('stat', 'E', f'Could not write the statistics: {os_error}', )
 
 
 def handle_sigint(signalnum, frame):
@@ -0,0 +1,50 @@
+"""Checks that shlerp --help only loads what it needs, the backup modules are imported by the runs that use them"""
+
+import subprocess
+import tempfile
+import unittest
+import json
+import sys
+import os
+
+SETUP_FLD = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules only needed to make, restore or upload a backup
+DEFERRED_MODULES = (
+    'tools.archive',
+    'tools.incremental',
+    'tools.store',
+    'tools.spool',
+    'tools.metrics',
+    'tools.clone',
+    'tarfile',
+    'concurrent.futures',
+    'requests'
+)
+
+HELP_SCRIPT = """
+import json, sys
+import main
+try:
+    main.main(['--help'])
+except SystemExit:
+    pass
+print(json.dumps(sorted(sys.modules)))
+"""
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_help_does_not_import_backup_modules(self):
+        with tempfile.TemporaryDirectory() as home:
+            result = subprocess.run(
+                [sys.executable, '-c', HELP_SCRIPT],
+                cwd=SETUP_FLD, env={**os.environ, 'HOME': home},
+                capture_output=True, text=True, check=True
+            )
+        modules = set(json.loads(result.stdout.splitlines()[-1]))
+        self.assertEqual([name for name in DEFERRED_MODULES if name in modules], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+"""Checks the --dedup backups: two backups of a project made within the same second keep their own index"""
+
+from tools.store import restore_store_snapshot
+from unittest import mock
+import tempfile
+import unittest
+import os
+
+OPTIONS = {
+    'noexcl': False,
+    'nogit': False,
+    'keephidden': False,
+    'gitignore': False,
+    'incremental': False,
+    'dedup': True,
+    'snapshot': False
+}
+
+
+def write_tree(root, files):
+    for rel_name, content in files.items():
+        os.makedirs(os.path.dirname(f'{root}/{rel_name}'), exist_ok=True)
+        with open(f'{root}/{rel_name}', 'w') as write_file:
+            write_file.write(content)
+
+
+def read_tree(root):
+    tree = {}
+    for folder, _, names in os.walk(root):
+        for name in names:
+            with open(f'{folder}/{name}', 'r') as read_file:
+                tree[os.path.relpath(f'{folder}/{name}', root)] = read_file.read()
+    return tree
+
+
+class TestDedup(unittest.TestCase):
+
+    def setUp(self):
+        self.work_fld = tempfile.TemporaryDirectory()
+        self.addCleanup(self.work_fld.cleanup)
+        # The logs are written into the temporary folder, not into the user ones
+        home_patch = mock.patch.dict(os.environ, {'HOME': self.work_fld.name})
+        home_patch.start()
+        self.addCleanup(home_patch.stop)
+        import main
+        from tools import utils
+        self.addCleanup(utils.flush_logs)
+        self.main = main
+        main.activate_headless()
+        main.set_state('total', 1)
+
+    def test_same_second_backups_keep_their_own_index(self):
+        proj_fld = f'{self.work_fld.name}/project'
+        # Both backups get the same name, as if they had been made within the same second
+        dst = f'{self.work_fld.name}/output/project_20260101#000000'
+        os.makedirs(os.path.dirname(dst))
+        first_tree = {'main.py': 'print(1)\n', 'lib/util.py': 'x = 1\n'}
+        write_tree(proj_fld, first_tree)
+        self.main.dedup_backup(proj_fld, dst, [], OPTIONS, 'test', 0, '')
+
+        second_tree = {**first_tree, 'main.py': 'print(2)\n', 'lib/new.py': 'y = 2\n'}
+        write_tree(proj_fld, second_tree)
+        self.main.dedup_backup(proj_fld, dst, [], OPTIONS, 'test', 0, '')
+
+        snapshots_fld = f'{self.work_fld.name}/output/.shlerp/store/snapshots'
+        indexes = sorted(os.listdir(snapshots_fld))
+        self.assertEqual(indexes, ['project_20260101#000000-1.json', 'project_20260101#000000.json'])
+        for index, tree in zip(indexes, (second_tree, first_tree)):
+            restore_dst = f'{self.work_fld.name}/{index}_restored'
+            restore_store_snapshot(f'{snapshots_fld}/{index}', restore_dst)
+            self.assertEqual(read_tree(restore_dst), tree)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+"""Checks the upload of the archives against a local HTTP server standing in for file.io"""
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from email.parser import BytesParser
+from email import policy
+from unittest import mock
+import threading
+import tempfile
+import unittest
+import socket
+import json
+import os
+
+from tools.state import activate_headless
+from tools.utils import get_settings
+from tools.spool import open_spool, publish
+from tools import piputils
+
+ARCHIVE = os.urandom(300 * 1024)
+BUFFER_SIZE = 64 * 1024
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Answers each upload with the next status of the server script, and keeps the requests it received"""
+
+    def do_POST(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            body = b''
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if not size:
+                    self.rfile.readline()
+                    break
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        else:
+            body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.received.append({'headers': dict(self.headers), 'body': body})
+
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        payload = json.dumps({'success': True, 'link': 'http://127.0.0.1/abc', 'expires': '2030-01-01T00:00:00.000Z'})
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload.encode())
+
+    def log_message(self, format, *args):
+        pass
+
+
+def parse_multipart(request):
+    """
+    :return: a dictionary holding the content of each part of a multipart/form-data body, by field name
+    """
+    head = f'Content-Type: {request["headers"]["Content-Type"]}\r\n\r\n'.encode()
+    message = BytesParser(policy=policy.HTTP).parsebytes(head + request['body'])
+    return {part.get_param('name', header='content-disposition'): part.get_payload(decode=True) for part in message.iter_parts()}
+
+
+def get_free_port():
+    """
+    :return: a local port nothing listens to
+    """
+    with socket.socket() as free_socket:
+        free_socket.bind(('127.0.0.1', 0))
+        return free_socket.getsockname()[1]
+
+
+class TestUpload(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        activate_headless()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.received = []
+        self.server.statuses = []
+        self.work_fld = tempfile.TemporaryDirectory()
+        self.archive_path = f'{self.work_fld.name}/project.zip'
+        with open(self.archive_path, 'wb') as write_archive:
+            write_archive.write(ARCHIVE)
+        # The upload settings point to the stand-in server, without waiting between the attempts
+        upload_settings = get_settings()['upload_default']
+        settings_patch = mock.patch.dict(upload_settings, {
+            'url': f'http://127.0.0.1:{self.server.server_port}/',
+            'buffer_size': BUFFER_SIZE,
+            'timeout': 10,
+            'retries': 3,
+            'backoff': 0
+        })
+        settings_patch.start()
+        self.addCleanup(settings_patch.stop)
+        print_patch = mock.patch.object(piputils, 'print_term')
+        self.print_term = print_patch.start()
+        self.addCleanup(print_patch.stop)
+        self.addCleanup(self.work_fld.cleanup)
+
+    def assert_archive_received(self, request):
+        fields = parse_multipart(request)
+        self.assertEqual(fields['expires'], b'1d')
+        self.assertEqual(fields['file'], ARCHIVE)
+
+    def test_body_parses_back_to_the_archive(self):
+        response = piputils.upload_archive(self.archive_path, '1d')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.server.received), 1)
+        request = self.server.received[0]
+        # The length is known up front, the body isn't sent chunked
+        self.assertEqual(int(request['headers']['Content-Length']), len(request['body']))
+        self.assert_archive_received(request)
+
+    def test_retries_after_503(self):
+        self.server.statuses = [503]
+        response = piputils.upload_archive(self.archive_path, '1d')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.server.received), 2)
+        # The body is read again from the beginning by the second attempt
+        for request in self.server.received:
+            self.assert_archive_received(request)
+        self.assertEqual(self.print_term.call_args_list[0].args[:2], ('uplo', 'W'))
+
+    def test_refused_connection_is_a_failure(self):
+        get_settings()['upload_default']['url'] = f'http://127.0.0.1:{get_free_port()}/'
+        get_settings()['upload_default']['retries'] = 1
+        self.assertIsNone(piputils.upload_archive(self.archive_path, '1d'))
+        levels = [call.args[1] for call in self.print_term.call_args_list]
+        self.assertEqual(levels, ['W', 'E'])
+
+    def write_spool(self, spool, fail=False):
+        """Writes the archive into the spool by blocks, as make_archive would"""
+        with open(spool['path'], 'ab') as write_archive:
+            for offset in range(0, len(ARCHIVE), BUFFER_SIZE):
+                write_archive.write(ARCHIVE[offset:offset + BUFFER_SIZE])
+                write_archive.flush()
+                publish(spool, write_archive.tell())
+                if fail:
+                    publish(spool, failed=True)
+                    return
+        publish(spool, len(ARCHIVE), done=True)
+
+    def upload_spool(self, fail=False):
+        spool = open_spool(f'{self.work_fld.name}/pipelined.zip')
+        writer = threading.Thread(target=self.write_spool, args=(spool, fail))
+        writer.start()
+        try:
+            return piputils.upload_spool(spool, '1d')
+        finally:
+            writer.join()
+
+    def test_pipelined_upload(self):
+        response = self.upload_spool()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.server.received), 1)
+        self.assertEqual(self.server.received[0]['headers'].get('Transfer-Encoding'), 'chunked')
+        self.assert_archive_received(self.server.received[0])
+
+    def test_pipelined_upload_falls_back_to_the_complete_archive(self):
+        self.server.statuses = [503]
+        response = self.upload_spool()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.server.received), 2)
+        streamed, complete = self.server.received
+        self.assertEqual(streamed['headers'].get('Transfer-Encoding'), 'chunked')
+        # The complete archive is sent again with its length, once it has been written
+        self.assertEqual(int(complete['headers']['Content-Length']), len(complete['body']))
+        self.assert_archive_received(complete)
+
+    def test_pipelined_upload_stops_if_the_archive_fails(self):
+        self.assertIsNone(self.upload_spool(fail=True))
+        # There is nothing left to upload, the complete archive isn't sent
+        self.assertLessEqual(len(self.server.received), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
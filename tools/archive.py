@@ -0,0 +1,354 @@
+###############################################################
+# This file features the archive writers used by make_archive.
+# Zip files are split into blocks that are deflated concurrently,
+# while a single writer appends the finished blocks in order.
+# Tar archives are streamed in one sequential pass.
+
+from tools.utils import ARCHIVE_FORMATS
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from collections import deque
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED, ZIP64_LIMIT
+import mimetypes
+import tarfile
+import gzip
+import lzma
+import zlib
+import os
+
+# Size of the blocks that are deflated independently. Big enough for the
+# restarted deflate window to cost next to nothing on the compression ratio
+BLOCK_SIZE = 1024 * 1024
+
+# Blocks that can be waiting for the writer, per worker. Bounds the memory used
+PENDING_PER_WORKER = 4
+
+_CRC_POLY = 0xedb88320
+
+
+def _multmodp(a, b):
+    """Multiplies two polynomials modulo the CRC-32 polynomial (as done by zlib's crc32_combine)"""
+    m = 1 << 31
+    p = 0
+    while True:
+        if a & m:
+            p ^= b
+            if (a & (m - 1)) == 0:
+                break
+        m >>= 1
+        b = (b >> 1) ^ _CRC_POLY if b & 1 else b >> 1
+    return p
+
+
+def _x2n_table():
+    table = [1 << 30]
+    for _ in range(31):
+        table.append(_multmodp(table[-1], table[-1]))
+    return table
+
+
+_X2N = _x2n_table()
+
+
+def crc32_combine(crc1, crc2, len2):
+    """Computes the CRC-32 of two concatenated buffers from the CRC-32 of each of them
+    :param crc1: CRC-32 of the first buffer
+    :param crc2: CRC-32 of the second buffer
+    :param len2: length of the second buffer
+    :return: the CRC-32 of the concatenation
+    """
+    p = 1 << 31
+    k = 3
+    while len2:
+        if len2 & 1:
+            p = _multmodp(_X2N[k & 31], p)
+        len2 >>= 1
+        k += 1
+    return _multmodp(p, crc1) ^ crc2
+
+
+def get_store_check(store_settings):
+    """Builds the function that tells if a file is already compressed and should be stored as is
+    :param store_settings: the compression.store section of settings.json
+    :return: a function taking a path and returning True if the file should be stored
+    """
+    extensions = {ext.lower() for ext in store_settings['extensions']}
+    mime_types = tuple(store_settings['mime_types'])
+
+    def should_store(path):
+        if os.path.splitext(path)[1].lower() in extensions:
+            return True
+        if mime_types:
+            mime_type, _ = mimetypes.guess_type(path)
+            return bool(mime_type) and mime_type.startswith(mime_types)
+        return False
+    return should_store
+
+
+def poorly_compressible(data, trial):
+    """Trial-compresses the beginning of a block with a fast level to see if deflating it is worth it
+    :param data: the raw block
+    :param trial: the compression.trial section of settings.json
+    :return: True if the sample did not shrink enough
+    """
+    sample = data[:trial['sample_size']]
+    if not sample:
+        return False
+    return len(zlib.compress(sample, 1)) / len(sample) > trial['ratio']
+
+
+def deflate_block(path, offset, size, level, last, trial=None):
+    """Reads and deflates one block of a file. Runs in a worker thread, zlib releases the GIL while compressing.
+    Blocks other than the last one end with a sync flush, so that the concatenation of
+    all the blocks of a file is a single valid raw deflate stream.
+    :param level: deflate level, None to keep the block as is (the entry is stored)
+    :param trial: optional, the compression.trial settings. Blocks that fail the trial are
+    emitted as stored deflate blocks (level 0)
+    :return: a tuple holding the compressed data, the CRC-32 and the length of the raw data
+    """
+    with open(path, 'rb') as read_file:
+        read_file.seek(offset)
+        data = read_file.read(size)
+    if level is None:
+        return data, zlib.crc32(data), len(data)
+    if trial and trial['enabled'] and level > 0 and poorly_compressible(data, trial):
+        level = 0
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return compressed, zlib.crc32(data), len(data)
+
+
+def write_entries(zip_archive, entries, compresslevel=9, workers=None, should_store=None, trial=None, on_commit=None):
+    """Writes entries into a zip archive, deflating the files in parallel.
+    The archive stays a standard zip file: entries are written in order with regular local headers.
+    :param zip_archive: ZipFile opened in 'w' mode on a seekable file
+    :param entries: iterable of (path, arcname) tuples
+    :param compresslevel: deflate level used for the files, 0 stores every file
+    :param workers: number of compression threads. Defaults to the number of CPUs
+    :param should_store: optional, function telling which files are stored (ZIP_STORED) instead of deflated
+    :param trial: optional, the compression.trial settings used to detect poorly compressible blocks
+    :param on_commit: optional, function called with the offset up to which the archive won't change anymore,
+    each time an entry is completed
+    :return: yields a (path, arcname, error) tuple for each entry once it has been written,
+    error being None if everything went fine
+    """
+    workers = workers or os.cpu_count() or 1
+    max_pending = workers * PENDING_PER_WORKER
+    pending = deque()
+    current = {}
+
+    def begin(zinfo):
+        # Mirrors ZipFile._open_to_write(): sizes and CRC are patched once the last block is written
+        zinfo.compress_size = 0
+        zinfo.CRC = 0
+        zinfo.flag_bits = 0x00
+        current['zip64'] = zinfo.file_size * 1.05 > ZIP64_LIMIT
+        zip_archive.fp.seek(zip_archive.start_dir)
+        zinfo.header_offset = zip_archive.fp.tell()
+        zip_archive._writecheck(zinfo)
+        zip_archive.fp.write(zinfo.FileHeader(current['zip64']))
+
+    def finish(zinfo):
+        zinfo.CRC = current['crc']
+        zinfo.file_size = current['size']
+        zinfo.compress_size = current['csize']
+        if not current['zip64'] and max(zinfo.file_size, zinfo.compress_size) > ZIP64_LIMIT:
+            raise RuntimeError('File size too large, try using force_zip64')
+        end = zip_archive.fp.tell()
+        zip_archive.fp.seek(zinfo.header_offset)
+        zip_archive.fp.write(zinfo.FileHeader(current['zip64']))
+        zip_archive.fp.seek(end)
+        zip_archive.filelist.append(zinfo)
+        zip_archive.NameToInfo[zinfo.filename] = zinfo
+        zip_archive.start_dir = end
+
+    def rollback(zinfo):
+        # Drops what has already been written for a file that couldn't be read entirely
+        zip_archive.fp.seek(zinfo.header_offset)
+        zip_archive.fp.truncate()
+        zip_archive.start_dir = zinfo.header_offset
+
+    def commit(result):
+        # The local headers are patched after the data, only the completed entries are final
+        if result and on_commit:
+            zip_archive.fp.flush()
+            on_commit(zip_archive.start_dir)
+        return result
+
+    def drain():
+        """Writes the oldest pending item, returns a result tuple when it completes an entry"""
+        kind, path, arcname, payload = pending.popleft()
+        if kind == 'error':
+            return path, arcname, payload
+        if kind == 'dir':
+            try:
+                zip_archive.write(path, arcname)
+            except Exception as e:
+                return path, arcname, e
+            return path, arcname, None
+
+        zinfo, index, last, future = payload
+        if index == 0:
+            current.update({'error': None, 'started': False, 'crc': 0, 'size': 0, 'csize': 0})
+        try:
+            compressed, crc, size = future.result()
+            if current['error'] is None:
+                if not current['started']:
+                    begin(zinfo)
+                    current['started'] = True
+                zip_archive.fp.write(compressed)
+                current['crc'] = crc32_combine(current['crc'], crc, size)
+                current['size'] += size
+                current['csize'] += len(compressed)
+        except Exception as e:
+            if current['error'] is None:
+                current['error'] = e
+        if last:
+            if current['error'] is None:
+                try:
+                    finish(zinfo)
+                except Exception as e:
+                    current['error'] = e
+            if current['error'] is not None and current['started']:
+                rollback(zinfo)
+            return path, arcname, current['error']
+        return None
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for path, arcname in entries:
+            try:
+                zinfo = ZipInfo.from_file(path, arcname)
+            except Exception as e:
+                pending.append(('error', path, arcname, e))
+                zinfo = None
+            if zinfo is not None:
+                if zinfo.is_dir():
+                    pending.append(('dir', path, arcname, None))
+                else:
+                    store = compresslevel == 0 or (should_store is not None and should_store(path))
+                    zinfo.compress_type = ZIP_STORED if store else ZIP_DEFLATED
+                    level = None if store else compresslevel
+                    blocks = max(1, -(-zinfo.file_size // BLOCK_SIZE))
+                    for index in range(blocks):
+                        last = index == blocks - 1
+                        # The last block reads until EOF, in case the file grew since it has been listed
+                        size = -1 if last else BLOCK_SIZE
+                        future = pool.submit(deflate_block, path, index * BLOCK_SIZE, size, level, last, trial)
+                        pending.append(('block', path, arcname, (zinfo, index, last, future)))
+                        while len(pending) > max_pending:
+                            result = commit(drain())
+                            if result:
+                                yield result
+            while len(pending) > max_pending:
+                result = commit(drain())
+                if result:
+                    yield result
+
+        while pending:
+            result = commit(drain())
+            if result:
+                yield result
+
+
+def _get_zstd():
+    """Gets a zstd implementation: the stdlib one (Python 3.14+), else the zstandard package
+    :return: a tuple holding the module and its flavor, or (None, None) if zstd is not available
+    """
+    try:
+        from compression import zstd
+        return zstd, 'stdlib'
+    except ImportError:
+        pass
+    try:
+        import zstandard
+        return zstandard, 'zstandard'
+    except ImportError:
+        return None, None
+
+
+def zstd_available():
+    return _get_zstd()[0] is not None
+
+
+@contextmanager
+def open_tar(path, archive_format, level, xz_level=6, zstd_level=3, workers=None):
+    """Opens a tar archive in stream mode: it is written in a single sequential pass, without any seek
+    :param path: path of the archive to create
+    :param archive_format: one of 'tar.gz', 'tar.xz' or 'tar.zst'
+    :param level: gzip level, from 0 to 9
+    :param xz_level: xz preset, used for 'tar.xz'. The memory of the compressor grows quickly with it (about 94MB
+    at 6, 674MB at 9), and there is one compressor per project processed at the same time
+    :param zstd_level: zstd level, used for 'tar.zst'
+    :param workers: number of zstd compression threads, 0 or None for one per CPU
+    :return: yields the TarFile to add entries to
+    """
+    with open(path, 'wb') as raw:
+        if archive_format == 'tar.gz':
+            compressed = gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=level)
+        elif archive_format == 'tar.xz':
+            compressed = lzma.LZMAFile(raw, 'wb', preset=xz_level)
+        elif archive_format == 'tar.zst':
+            zstd, flavor = _get_zstd()
+            if zstd is None:
+                raise RuntimeError('zstd needs Python 3.14+ or the zstandard package')
+            if flavor == 'stdlib':
+                compressed = zstd.ZstdFile(raw, 'w', level=zstd_level)
+            else:
+                compressed = zstd.ZstdCompressor(level=zstd_level, threads=workers or -1).stream_writer(raw)
+        else:
+            raise ValueError(f'Unsupported archive format: {archive_format}')
+
+        try:
+            with tarfile.open(fileobj=compressed, mode='w|') as tar_archive:
+                yield tar_archive
+        finally:
+            compressed.close()
+
+
+def write_tar_entries(tar_archive, entries):
+    """Adds entries to a tar archive, one after another
+    :param tar_archive: TarFile opened by open_tar()
+    :param entries: iterable of (path, arcname) tuples
+    :return: yields a (path, arcname, error) tuple for each entry once it has been added,
+    error being None if everything went fine
+    """
+    for path, arcname in entries:
+        # The project folder itself, the tar entries are already relative to it
+        if not arcname:
+            continue
+        try:
+            tar_archive.add(path, arcname, recursive=False)
+        except Exception as e:
+            yield path, arcname, e
+        else:
+            yield path, arcname, None
+
+
+def extract_archive(path, archive_format, dst):
+    """Extracts an archive made by shlerp into a folder, overwriting the files that already exist
+    :param path: path of the archive
+    :param archive_format: one of the ARCHIVE_FORMATS keys
+    :param dst: the folder to extract the archive into
+    """
+    if archive_format == 'zip':
+        with ZipFile(path) as zip_archive:
+            zip_archive.extractall(dst)
+        return
+
+    with open(path, 'rb') as raw:
+        if archive_format == 'tar.zst':
+            zstd, flavor = _get_zstd()
+            if zstd is None:
+                raise RuntimeError('zstd needs Python 3.14+ or the zstandard package')
+            if flavor == 'stdlib':
+                compressed = zstd.ZstdFile(raw, 'r')
+            else:
+                compressed = zstd.ZstdDecompressor().stream_reader(raw)
+        else:
+            compressed = raw
+        with tarfile.open(fileobj=compressed, mode='r|*') as tar_archive:
+            # The data filter refuses absolute paths & links escaping dst, when available (Python 3.12+)
+            if hasattr(tarfile, 'data_filter'):
+                tar_archive.extractall(dst, filter='data')
+            else:
+                tar_archive.extractall(dst)
@@ -0,0 +1,155 @@
+###############################################################
+# This file features the copy engine used by duplicate(), and the
+# snapshot mode used by --snapshot. In snapshot mode, files are
+# cloned with a reflink where the filesystem supports it,
+# hardlinked against the previous backup when they didn't change,
+# or copied by the kernel without going through Python.
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from os.path import exists
+import threading
+import shutil
+import errno
+import sys
+import re
+import os
+
+# ioctl request number of FICLONE on Linux, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+# Errors meaning that the filesystem or the kernel can't do the operation, the next method is used instead
+_UNSUPPORTED = {errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.EOPNOTSUPP, errno.ENOSYS, errno.EPERM, errno.EBADF}
+# (source device, destination device) pairs where reflinks or copy_file_range failed, they aren't tried again
+_no_reflink = set()
+_no_copy_range = set()
+_lock = threading.Lock()
+# Number of copies queued per worker, ahead of the one being reported
+PENDING_PER_WORKER = 4
+
+
+def find_previous_backup(dst):
+    """Finds the most recent backup of the same project, next to the destination
+    :param dst: text, the backup destination, named {project}_{get_dt()}
+    :return: The path of the previous backup, or None
+    """
+    backups_fld, name = os.path.split(dst)
+    project = name.rsplit('_', 1)[0]
+    pattern = re.compile(rf'{re.escape(project)}_\d{{8}}#\d{{6}}')
+    previous = sorted(
+        elem for elem in os.listdir(backups_fld)
+        if elem != name and pattern.fullmatch(elem) and os.path.isdir(f'{backups_fld}/{elem}')
+    )
+    return f'{backups_fld}/{previous[-1]}' if previous else None
+
+
+def _reflink(src, dst, devices):
+    if not sys.platform.startswith('linux') or devices in _no_reflink:
+        return False
+    import fcntl
+    with open(src, 'rb') as read_file, open(dst, 'wb') as write_file:
+        try:
+            fcntl.ioctl(write_file.fileno(), FICLONE, read_file.fileno())
+            return True
+        except OSError as os_error:
+            if os_error.errno not in _UNSUPPORTED:
+                raise
+            with _lock:
+                _no_reflink.add(devices)
+    os.remove(dst)
+    return False
+
+
+def _hardlink(src, dst, prev):
+    """Links the file of the previous backup if the source didn't change since then"""
+    if prev is None:
+        return False
+    try:
+        src_stat = os.stat(src)
+        prev_stat = os.stat(prev)
+    except OSError:
+        return False
+    if src_stat.st_size != prev_stat.st_size or src_stat.st_mtime_ns != prev_stat.st_mtime_ns:
+        return False
+    try:
+        os.link(prev, dst)
+        return True
+    except OSError as os_error:
+        if os_error.errno not in _UNSUPPORTED and os_error.errno != errno.EMLINK:
+            raise
+        return False
+
+
+def _kernel_copy(src, dst, devices):
+    """Copies a file with copy_file_range, or with shutil which relies on sendfile on Linux"""
+    if hasattr(os, 'copy_file_range') and devices not in _no_copy_range:
+        with open(src, 'rb') as read_file, open(dst, 'wb') as write_file:
+            try:
+                while os.copy_file_range(read_file.fileno(), write_file.fileno(), 1 << 30):
+                    pass
+                return
+            except OSError as os_error:
+                if os_error.errno not in _UNSUPPORTED:
+                    raise
+                with _lock:
+                    _no_copy_range.add(devices)
+    shutil.copyfile(src, dst)
+
+
+def clone_file(src, dst, prev=None):
+    """Clones a file with the cheapest method available: reflink, hardlink against the previous backup, then kernel copy
+    :param src: text, the file to clone
+    :param dst: text, the destination of the file
+    :param prev: text, the same file in the previous backup, if any
+    :return: 'reflink', 'hardlink' or 'copy'
+    """
+    devices = (os.stat(src).st_dev, os.stat(os.path.dirname(dst) or '.').st_dev)
+    if _reflink(src, dst, devices):
+        method = 'reflink'
+    elif _hardlink(src, dst, prev):
+        # The link shares the metadata of the previous backup, which already matches the source
+        return 'hardlink'
+    else:
+        _kernel_copy(src, dst, devices)
+        method = 'copy'
+    shutil.copystat(src, dst)
+    return method
+
+
+def get_cloner(proj_fld, prev):
+    """
+    :param proj_fld: text, the project folder
+    :param prev: text, the previous backup of the project, or None
+    :return: A function cloning a file of the project, returns the method that has been used
+    """
+    def clone(src, file_dst):
+        rel_name = os.path.relpath(src, proj_fld)
+        prev_path = f'{prev}/{rel_name}' if prev and exists(f'{prev}/{rel_name}') else None
+        return clone_file(src, file_dst, prev_path)
+    return clone
+
+
+def copy_files(jobs, copy_file, workers=8):
+    """Copies files through a pool of threads. The destination folders must already exist
+    :param jobs: iterable of tuples starting with the source and the destination of a file
+    :param copy_file: function copying a single file, called with the source and the destination
+    :param workers: number of files copied at the same time
+    :return: yields (job, result, error) tuples, in the order of the jobs
+    """
+    def copy(job):
+        try:
+            return job, copy_file(job[0], job[1]), None
+        except Exception as exc:
+            return job, None, exc
+
+    if workers <= 1:
+        yield from map(copy, jobs)
+        return
+    # Results are reported in order, the number of pending copies is bounded to keep memory usage flat
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for job in jobs:
+            pending.append(pool.submit(copy, job))
+            if len(pending) >= workers * PENDING_PER_WORKER:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
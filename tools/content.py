@@ -0,0 +1,85 @@
+###############################################################
+# This file features the content matching used by the framework
+# rules that define a "pattern". Files are searched in byte mode
+# over a memory map, up to a size limit, and the outcome of each
+# search is kept for the rest of the run.
+
+import threading
+import mmap
+import re
+import os
+
+# Compiled patterns, by pattern text
+_patterns = {}
+# Outcome of the searches: (path, mtime_ns, size, pattern) -> True/False
+_results = {}
+_lock = threading.Lock()
+
+
+def compile_pattern(pattern):
+    """Compiles a rule pattern once for the whole run. Patterns are matched against bytes, so that binary or
+    non UTF-8 files can be searched too
+    :param pattern: text, the regex defined by the rule
+    :return: the compiled regex
+    """
+    compiled = _patterns.get(pattern)
+    if compiled is None:
+        compiled = re.compile(pattern.encode())
+        with _lock:
+            _patterns[pattern] = compiled
+    return compiled
+
+
+def _search(path, regexes, max_bytes):
+    """Searches the first max_bytes of a file
+    :return: list holding whether each regex has been found
+    """
+    with open(path, 'rb') as read_file:
+        size = min(os.fstat(read_file.fileno()).st_size, max_bytes)
+        if not size:
+            return [bool(regex.search(b'')) for regex in regexes]
+        try:
+            # Only the first max_bytes are mapped, the page cache is shared by the searches
+            data = mmap.mmap(read_file.fileno(), size, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # Files that can't be mapped (special or remote files) are read, up to the same limit
+            data = read_file.read(size)
+        try:
+            return [bool(regex.search(data)) for regex in regexes]
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+
+def search_file(path, patterns, max_bytes, stat=None):
+    """Searches patterns in a file. Each file is opened once for all the patterns that aren't cached yet,
+    then the outcome is cached until the file changes, so that several rules checking the same file read it once
+    :param path: text, the file to search
+    :param patterns: iterable of patterns (text)
+    :param max_bytes: number, only the beginning of the file is searched, up to this size
+    :param stat: optional, the os.stat_result of the file if already known
+    :return: the set of the patterns found in the file. Files that can't be read match nothing
+    """
+    try:
+        stat = stat or os.stat(path)
+    except OSError:
+        return set()
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    found = set()
+    missing = []
+    for pattern in dict.fromkeys(patterns):
+        cached = _results.get(key + (pattern,))
+        if cached is None:
+            missing.append(pattern)
+        elif cached:
+            found.add(pattern)
+    if missing:
+        try:
+            outcomes = _search(path, [compile_pattern(pattern) for pattern in missing], max_bytes)
+        except OSError:
+            return found
+        with _lock:
+            for pattern, outcome in zip(missing, outcomes):
+                _results[key + (pattern,)] = outcome
+        found.update(pattern for pattern, outcome in zip(missing, outcomes) if outcome)
+    return found
@@ -0,0 +1,134 @@
+###############################################################
+# This file features the exclusion engine shared by the backup
+# modes and the rule detection system. Exclusion entries match
+# whole path components: "target" excludes a target/ folder but
+# not my_target_notes.md, ".git" doesn't exclude .github/.
+
+from tools.gitignore import IGNORE_FILE, ROOT_IGNORE_FILES, read_ignore, is_ignored
+from fnmatch import translate
+import re
+import os
+
+# Always left out of the backups
+DEFAULT_EXCLUSIONS = ('.DS_Store',)
+# Hidden elements that are kept without --keephidden
+GIT_ELEMENTS = ('.git', '.gitignore')
+
+
+def compile_terms(terms, keephidden=True):
+    """Compiles a list of exclusion entries into a matcher.
+    Plain names are looked up in a set, one path segment at a time. Globs (*.log) are compiled into a single regex
+    matched against a path segment, entries holding a slash (storage/logs) into a single regex matched against the path
+    :param terms: iterable of exclusion entries
+    :param keephidden: if False, hidden elements at the root of the project are excluded, except the git ones
+    :return: dictionary/object representing the matcher
+    """
+    names = set()
+    globs = []
+    paths = []
+    for term in terms:
+        term = term.strip('/')
+        if not term:
+            continue
+        if '/' in term:
+            paths.append(term)
+        elif any(char in term for char in '*?['):
+            globs.append(term)
+        else:
+            names.add(term)
+    return {
+        'names': frozenset(names),
+        'globs': re.compile('|'.join(translate(glob) for glob in globs)) if globs else None,
+        'paths': re.compile(
+            '(?:^|/)(?:' + '|'.join(re.escape(path) for path in paths) + ')(?:/|$)'
+        ) if paths else None,
+        'keephidden': keephidden,
+        'gitignore': False
+    }
+
+
+def compile_exclusions(rules, options):
+    """Compiles the exclusions of the detected rules and the exclusion options into a matcher
+    :param rules: list of dictionaries/objects representing the rules/languages corresponding to the project
+    :param options: dictionary/object containing exclusion options (noexcl, nogit, keephidden)
+    :return: dictionary/object representing the matcher
+    """
+    terms = set(DEFAULT_EXCLUSIONS)
+    for rule in rules:
+        if 'actions' in rule and 'exclude' in rule['actions']:
+            exclude = rule['actions']['exclude']
+            # Dependency folders are left out even when the rule exclusions are disabled
+            terms.update(exclude.get('dep_folders') or [])
+            if not options['noexcl']:
+                terms.update(exclude.get('files') or [])
+                terms.update(exclude.get('folders') or [])
+    if options['nogit']:
+        terms.update(GIT_ELEMENTS)
+    matcher = compile_terms(terms, options['keephidden'])
+    matcher['gitignore'] = options.get('gitignore', False)
+    return matcher
+
+
+def is_excluded(matcher, rel_name, name=None):
+    """Checks a single element, assuming that the folders it is in have already been checked.
+    This is what walkers use: once a folder is excluded, its content is never looked at
+    :param matcher: dictionary/object returned by compile_terms() or compile_exclusions()
+    :param rel_name: text, path of the element relative to the project folder
+    :param name: text, the last segment of rel_name if already known
+    :return: True if the element is excluded
+    """
+    if name is None:
+        name = rel_name.rpartition('/')[2]
+    if name in matcher['names']:
+        return True
+    if matcher['globs'] and matcher['globs'].match(name):
+        return True
+    if matcher['paths'] and matcher['paths'].search(rel_name):
+        return True
+    if not matcher['keephidden'] and name.startswith('.') and name not in GIT_ELEMENTS and name == rel_name:
+        return True
+    return False
+
+
+def walk(proj_fld, matcher):
+    """Walks a project folder with os.scandir(), the excluded folders are never entered.
+    Hidden files are listed like any other file, the matcher decides whether they are kept.
+    If the matcher has been compiled with the gitignore option, the ignore files met along the way are applied too
+    :param proj_fld: text, the project folder
+    :param matcher: dictionary/object returned by compile_terms() or compile_exclusions()
+    :return: yields (path, rel_name, is_dir) tuples, folders come before their content
+    """
+    ignores = []
+    if matcher['gitignore']:
+        ignores = [
+            compiled for compiled in (read_ignore(f'{proj_fld}/{ignore_file}') for ignore_file in ROOT_IGNORE_FILES)
+            if compiled
+        ]
+    # Each stack entry holds a folder, its path relative to the project and the ignore files that apply to it
+    stack = [(proj_fld, '', ignores)]
+    while stack:
+        root, rel_root, ignores = stack.pop()
+        if matcher['gitignore']:
+            compiled = read_ignore(f'{root}/{IGNORE_FILE}', rel_root)
+            if compiled:
+                ignores = ignores + [compiled]
+        try:
+            with os.scandir(root) as iterator:
+                entries = list(iterator)
+        except OSError:
+            continue
+        for entry in entries:
+            rel_name = f'{rel_root}/{entry.name}' if rel_root else entry.name
+            if is_excluded(matcher, rel_name, entry.name):
+                continue
+            try:
+                # Linked folders are followed, like shutil.copytree() does
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            # The .git folder is never matched by ignore files, like git does
+            if ignores and entry.name != '.git' and is_ignored(ignores, rel_name, is_dir):
+                continue
+            yield entry.path, rel_name, is_dir
+            if is_dir:
+                stack.append((entry.path, rel_name, ignores))
@@ -0,0 +1,144 @@
+###############################################################
+# This file features the .gitignore support used by --gitignore.
+# The patterns of each ignore file are compiled into regexes,
+# following the syntax described in gitignore(5), and evaluated
+# by the walker with the same precedence as git.
+
+import re
+
+# Ignore files read in each folder of the project, and at the root of the project only
+IGNORE_FILE = '.gitignore'
+ROOT_IGNORE_FILES = ('.git/info/exclude',)
+
+
+def translate(pattern):
+    """Translates a gitignore pattern into a regex, "*" and "?" don't match slashes and "**" spans folders
+    :param pattern: text, the pattern without its "!" prefix and its trailing slash
+    :return: text, the regex matching the paths relative to the folder of the ignore file
+    """
+    res = ''
+    i = 0
+    size = len(pattern)
+    while i < size:
+        char = pattern[i]
+        if char == '*':
+            if pattern[i:i + 2] == '**' and (i == 0 or pattern[i - 1] == '/') and (i + 2 == size or pattern[i + 2] == '/'):
+                if i + 2 == size:
+                    # Trailing "/**": everything inside
+                    res += '.*'
+                    i += 2
+                else:
+                    # Leading "**/" or "/**/": zero or more folders
+                    res += '(?:.*/)?'
+                    i += 3
+                continue
+            while i < size and pattern[i] == '*':
+                i += 1
+            res += '[^/]*'
+            continue
+        if char == '?':
+            res += '[^/]'
+        elif char == '[':
+            # A "]" right after the opening bracket (or its negation) is part of the class
+            end = pattern.find(']', i + 3 if pattern[i + 1:i + 2] in ('!', '^') else i + 2)
+            if end == -1:
+                res += re.escape(char)
+            else:
+                body = pattern[i + 1:end].replace('\\', '\\\\')
+                if body[0] in ('!', '^'):
+                    body = '^' + body[1:]
+                res += f'[{body}]'
+                i = end
+        elif char == '\\' and i + 1 < size:
+            i += 1
+            res += re.escape(pattern[i])
+        else:
+            res += re.escape(char)
+        i += 1
+    return res
+
+
+def compile_ignore(lines, base=''):
+    """Compiles the content of an ignore file
+    :param lines: iterable of text lines
+    :param base: text, the folder holding the ignore file, relative to the project folder
+    :return: dictionary/object representing the compiled ignore file, or None if it has no pattern
+    """
+    patterns = []
+    for line in lines:
+        line = line.rstrip('\r\n')
+        # Trailing spaces are ignored unless escaped
+        stripped = line.rstrip(' ')
+        if stripped.endswith('\\') and len(stripped) < len(line):
+            stripped += ' '
+        line = stripped
+        if not line or line.startswith('#'):
+            continue
+        negate = line.startswith('!')
+        if negate:
+            line = line[1:]
+        dir_only = line.endswith('/')
+        line = line.rstrip('/')
+        if not line:
+            continue
+        # A pattern holding a slash is relative to the folder of the ignore file, otherwise it matches at any depth
+        if '/' in line:
+            regex = translate(line.lstrip('/'))
+        else:
+            regex = '(?:.*/)?' + translate(line)
+        patterns.append((re.compile(regex + r'\Z', re.DOTALL), negate, dir_only))
+
+    if not patterns:
+        return None
+    compiled = {'base': base, 'patterns': patterns, 'files': None, 'folders': None}
+    if not any(negate for _, negate, _ in patterns):
+        # Without negation the first match decides, all the patterns are merged into one regex
+        compiled['files'] = re.compile('|'.join(p.pattern for p, _, dir_only in patterns if not dir_only) or r'(?!)', re.DOTALL)
+        compiled['folders'] = re.compile('|'.join(p.pattern for p, _, _ in patterns), re.DOTALL)
+    return compiled
+
+
+def read_ignore(path, base=''):
+    """
+    :param path: text, the path of an ignore file
+    :param base: text, the folder holding the ignore file, relative to the project folder
+    :return: dictionary/object representing the compiled ignore file, or None if it doesn't exist or has no pattern
+    """
+    try:
+        with open(path, 'r', errors='replace') as read_file:
+            return compile_ignore(read_file, base)
+    except OSError:
+        return None
+
+
+def match_ignore(compiled, rel_name, is_dir):
+    """Evaluates a path against a compiled ignore file, the last matching pattern wins
+    :param compiled: dictionary/object returned by compile_ignore()
+    :param rel_name: text, path of the element relative to the project folder
+    :param is_dir: True if the element is a folder
+    :return: True if ignored, False if re-included by a negated pattern, None if no pattern matched
+    """
+    if compiled['base']:
+        rel_name = rel_name[len(compiled['base']) + 1:]
+    if compiled['folders'] is not None:
+        return bool((compiled['folders'] if is_dir else compiled['files']).match(rel_name)) or None
+    for regex, negate, dir_only in reversed(compiled['patterns']):
+        if dir_only and not is_dir:
+            continue
+        if regex.match(rel_name):
+            return not negate
+    return None
+
+
+def is_ignored(ignores, rel_name, is_dir):
+    """Evaluates a path against the ignore files that apply to it, the deepest ones take precedence
+    :param ignores: list of compiled ignore files, from the root of the project to the folder of the element
+    :param rel_name: text, path of the element relative to the project folder
+    :param is_dir: True if the element is a folder
+    :return: True if the element is ignored
+    """
+    for compiled in reversed(ignores):
+        verdict = match_ignore(compiled, rel_name, is_dir)
+        if verdict is not None:
+            return verdict
+    return False
@@ -0,0 +1,180 @@
+###############################################################
+# This file features the manifest system used by incremental
+# backups. Each project gets a manifest in the .shlerp folder of
+# the output location, listing the state of every backed up file
+# and the chain of snapshots that have been made so far.
+
+from tools.archive import ARCHIVE_FORMATS, extract_archive
+from tools.utils import get_dt, write_atomic
+from os.path import exists
+import hashlib
+import shutil
+import json
+import os
+
+
+def get_manifest_path(proj_fld, dst):
+    """
+    :param proj_fld: text, the project folder
+    :param dst: text, the backup destination, without extension
+    :return: The path of the manifest of the project, in the folder where its backups are stored
+    """
+    proj_fld = os.path.abspath(proj_fld)
+    # The path hash avoids collisions between projects sharing the same name
+    path_hash = hashlib.sha1(proj_fld.encode()).hexdigest()[:8]
+    return f'{os.path.dirname(dst)}/.shlerp/{os.path.basename(proj_fld)}_{path_hash}.json'
+
+
+def load_manifest(manifest_path):
+    try:
+        with open(manifest_path, 'r') as read_manifest:
+            return json.load(read_manifest)
+    except FileNotFoundError:
+        return {'files': {}, 'snapshots': []}
+
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as read_file:
+        for chunk in iter(lambda: read_file.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def open_snapshot(proj_fld, dst, kind, use_hash=False):
+    """Prepares a new snapshot of a project, based on its manifest
+    :param proj_fld: text, the project folder
+    :param dst: text, the backup destination, without extension
+    :param kind: 'copy' or the archive format used for this backup
+    :param use_hash: if True, files whose mtime changed but not their size are compared by content
+    :return: dictionary/object representing the snapshot being made
+    """
+    manifest_path = get_manifest_path(proj_fld, dst)
+    manifest = load_manifest(manifest_path)
+    name = os.path.basename(dst)
+    if kind != 'copy':
+        name += ARCHIVE_FORMATS[kind]
+    return {
+        'manifest_path': manifest_path,
+        'manifest': manifest,
+        'name': name,
+        'kind': kind,
+        'use_hash': use_hash,
+        'files': {},  # State of the files once this snapshot is done
+        'pending': {},  # State of the changed files, until they are actually backed up
+        'changed': [],
+        'seen': set()
+    }
+
+
+def select_changed(snapshot, entries):
+    """Filters the entries of a backup, only keeping the files that are new or changed since the previous snapshot
+    :param snapshot: dictionary/object returned by open_snapshot()
+    :param entries: iterable of (path, rel_name) tuples. Folders are skipped
+    :return: yields the (path, rel_name) tuples that need to be backed up
+    """
+    previous = snapshot['manifest']['files']
+    for path, rel_name in entries:
+        if os.path.isdir(path):
+            continue
+        snapshot['seen'].add(rel_name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # Let the backup step report the error
+            yield path, rel_name
+            continue
+
+        file_state = [stat.st_size, stat.st_mtime_ns, None]
+        prev_state = previous.get(rel_name)
+        changed = prev_state is None or prev_state[0] != file_state[0] or prev_state[1] != file_state[1]
+
+        if changed and snapshot['use_hash']:
+            file_state[2] = file_hash(path)
+            # Same size and same content: only the mtime changed
+            if prev_state is not None and prev_state[0] == file_state[0] and prev_state[2] == file_state[2]:
+                changed = False
+
+        if changed:
+            snapshot['pending'][rel_name] = file_state
+            yield path, rel_name
+        else:
+            if prev_state is not None and file_state[2] is None:
+                file_state[2] = prev_state[2]
+            snapshot['files'][rel_name] = file_state
+
+
+def record_done(snapshot, rel_name):
+    """Marks a changed file as backed up"""
+    file_state = snapshot['pending'].pop(rel_name, None)
+    if file_state is not None:
+        snapshot['files'][rel_name] = file_state
+        snapshot['changed'].append(rel_name)
+
+
+def commit_snapshot(snapshot):
+    """Adds the snapshot to the chain and writes the manifest.
+    Files that couldn't be backed up keep their previous state, so they will be retried next time
+    :param snapshot: dictionary/object returned by open_snapshot()
+    """
+    manifest = snapshot['manifest']
+    previous = manifest['files']
+    for rel_name in snapshot['pending']:
+        if rel_name in previous:
+            snapshot['files'][rel_name] = previous[rel_name]
+
+    manifest['snapshots'].append({
+        'name': snapshot['name'],
+        'kind': snapshot['kind'],
+        'created': get_dt(),
+        'changed': snapshot['changed'],
+        'deleted': sorted(rel_name for rel_name in previous if rel_name not in snapshot['seen'])
+    })
+    manifest['files'] = snapshot['files']
+
+    os.makedirs(os.path.dirname(snapshot['manifest_path']), exist_ok=True)
+    write_atomic(snapshot['manifest_path'], json.dumps(manifest))
+
+
+def find_snapshot(backup_path):
+    """Finds the manifest that references a backup
+    :param backup_path: text, path of a backup made in incremental mode
+    :return: a tuple holding the manifest and the position of the backup in its chain, or (None, None)
+    """
+    backup_path = os.path.abspath(backup_path).rstrip('/')
+    manifest_fld = f'{os.path.dirname(backup_path)}/.shlerp'
+    name = os.path.basename(backup_path)
+    if exists(manifest_fld):
+        for manifest_file in os.listdir(manifest_fld):
+            if not manifest_file.endswith('.json'):
+                continue
+            manifest = load_manifest(f'{manifest_fld}/{manifest_file}')
+            for position, snapshot in enumerate(manifest['snapshots']):
+                if snapshot['name'] == name:
+                    return manifest, position
+    return None, None
+
+
+def restore_snapshot(backup_path, dst):
+    """Rebuilds the full project as it was when a backup has been made, by replaying
+    the chain of snapshots up to this backup
+    :param backup_path: text, path of a backup made in incremental mode
+    :param dst: text, the folder to restore the project into. Must not exist
+    :return: the number of snapshots that have been replayed, 0 if the backup isn't part of a chain
+    """
+    manifest, position = find_snapshot(backup_path)
+    if manifest is None:
+        return 0
+    backups_fld = os.path.dirname(os.path.abspath(backup_path).rstrip('/'))
+    os.makedirs(dst)
+    for snapshot in manifest['snapshots'][:position + 1]:
+        for rel_name in snapshot['deleted']:
+            deleted_path = f'{dst}/{rel_name}'
+            if exists(deleted_path):
+                os.remove(deleted_path)
+        snapshot_path = f'{backups_fld}/{snapshot["name"]}'
+        if snapshot['kind'] == 'copy':
+            shutil.copytree(snapshot_path, dst, dirs_exist_ok=True)
+        else:
+            extract_archive(snapshot_path, snapshot['kind'], dst)
+    return position + 1
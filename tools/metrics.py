@@ -0,0 +1,79 @@
+###############################################################
+# This file features the export of the metrics recorded in the
+# state during a run: as JSON with --stats-json, or in the
+# Prometheus text format with --stats-prom, for the textfile
+# collector of the node exporter.
+
+from tools.utils import write_atomic
+import json
+import os
+
+# Prometheus metric name, help text and key in the stage metrics
+PROMETHEUS_METRICS = (
+    ('shlerp_stage_duration_seconds', 'Wall time of the stage', 'wall_time'),
+    ('shlerp_stage_files', 'Number of files processed by the stage', 'files'),
+    ('shlerp_stage_read_bytes', 'Number of bytes read from the project', 'bytes_read'),
+    ('shlerp_stage_written_bytes', 'Number of bytes written into the backup or uploaded', 'bytes_written'),
+    ('shlerp_stage_compression_ratio', 'Bytes written divided by bytes read', 'compression_ratio'),
+    ('shlerp_stage_errors', 'Number of errors met by the stage', 'errors')
+)
+
+
+def build_stats(uid, started, runtime, metrics):
+    """
+    :param uid: text, the uid of the run
+    :param started: number, the time when the run started (epoch)
+    :param runtime: number of seconds the run took
+    :param metrics: dictionary/object holding the metrics of each stage, by project path (see state.record_stage())
+    :return: dictionary/object representing the statistics of the run
+    """
+    return {
+        'uid': uid,
+        'started': started,
+        'runtime': runtime,
+        'projects': [
+            {'path': path, 'name': os.path.basename(path), 'stages': stages}
+            for path, stages in metrics.items()
+        ]
+    }
+
+
+def write_stats_json(path, stats):
+    """
+    :param path: text, the file to write
+    :param stats: dictionary/object returned by build_stats()
+    """
+    write_atomic(path, json.dumps(stats, indent=4))
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _value(value):
+    return str(value) if isinstance(value, int) else f'{value:.6f}'
+
+
+def write_prometheus(path, stats):
+    """Writes the statistics in the Prometheus text format. The file is replaced atomically, as the textfile
+    collector may read it at any time
+    :param path: text, the file to write, usually a .prom file in the folder read by the textfile collector
+    :param stats: dictionary/object returned by build_stats()
+    """
+    lines = [
+        '# HELP shlerp_last_run_timestamp_seconds Time when the last run started',
+        '# TYPE shlerp_last_run_timestamp_seconds gauge',
+        f'shlerp_last_run_timestamp_seconds {_value(stats["started"])}',
+        '# HELP shlerp_run_duration_seconds Wall time of the last run',
+        '# TYPE shlerp_run_duration_seconds gauge',
+        f'shlerp_run_duration_seconds {_value(stats["runtime"])}'
+    ]
+    for name, help_text, key in PROMETHEUS_METRICS:
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge']
+        for project in stats['projects']:
+            for stage, values in project['stages'].items():
+                if values[key] is None:
+                    continue
+                labels = f'project="{_label(project["name"])}",path="{_label(project["path"])}",stage="{stage}"'
+                lines.append(f'{name}{{{labels}}} {_value(values[key])}')
+    write_atomic(path, '\n'.join(lines) + '\n')
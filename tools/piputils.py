@@ -9,48 +9,105 @@ from tools.state import (
     after_warning,
     x_consecutive_entries_in_step
 )
-from datetime import datetime
+from datetime import datetime, timezone
 from tools.utils import (
     log,
     get_dt,
-    spinner_animation,
+    get_settings,
     remove_previous_line
 )
 from click import echo
 import threading
-import requests
-import pytz
+import time
+import sys
+import os
 import click
 
+# requests is only imported when an upload is done, it is the slowest import of the CLI
 
-def print_term(step, lvl, message, **kwargs):
+# Serializes the terminal output
+output_lock = threading.RLock()
+# Holds the lines of the project processed by the current thread when its output is buffered
+_output = threading.local()
+# Number of times per second the progress line is redrawn at most
+PROGRESS_RATE = 10
+# True while a progress line is drawn, it is cleared before any other line is printed
+_progress_shown = False
+# Size limit of the uploads (2GB)
+MAX_UPLOAD_SIZE = 2 * 1024 ** 3
+# Format of the expiration dates returned by file.io, in UTC
+EXPIRY_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+# Shared by the uploads of the current run
+_session = None
+_session_lock = threading.Lock()
+
+
+def run_buffered(func, *args):
+    """Runs a function while holding back the terminal output it produces. The output is then
+    printed in one block, so that the lines of concurrently processed projects don't get mixed up
+    :param func: the function to run
+    :return: what the function returned
+    """
+    _output.buffer = []
+    try:
+        return func(*args)
+    finally:
+        lines = _output.buffer
+        _output.buffer = None
+        with output_lock:
+            for line in lines:
+                echo(line)
+
+
+def _emit(string):
+    """Prints a line right away, or keeps it for later if the output of the current thread is buffered"""
+    global _progress_shown
+    buffer = getattr(_output, 'buffer', None)
+    if buffer is not None:
+        buffer.append(string)
+    else:
+        with output_lock:
+            if _progress_shown:
+                sys.stdout.write('\r\033[K')
+                _progress_shown = False
+            echo(string)
+
+
+def print_term(step, lvl, message, uid=None, **kwargs):
     """Standardizes the output format
     :param step, short string that indicates to the user the step we are going through
     :param lvl, letter that indicates if the displayed message is an Info, Warning or Error
     :param message, the message we want to print
+    :param uid, optional, the uid of the current execution. Taken from the state if not provided
+    :param kwargs: cnt, the current count out of a total of backups. input, set to True to prompt the user.
+    quiet, set to True to only log the message
     :return: The user input if input is set to True
     """
-    uid = None
     u_input = False
+    quiet = False
     count = ''
     log_type = 'exec'
     if step in ['setup', 'uninstall']:
         log_type = step
-    if state('uid'):
+    if not uid and state('uid'):
         uid = state('uid')
     for kwarg, val in kwargs.items():
         if 'cnt' in kwarg and val != '':
             count = f'[{kwargs["cnt"]}]'
         if 'input' in kwarg:
             u_input = True
+        if 'quiet' in kwarg and val:
+            quiet = True
 
     string = f'{step}]{count}[{lvl}] {message}'
     if not state('debug'):
         log(f'[{uid + ":" if uid else ""}{get_dt()}:{string}', log_type)
 
-    if not state('headless'):
+    if not state('headless') and not quiet:
+        # Buffered lines are printed in one block afterwards, so they can't overwrite each other
+        buffered = getattr(_output, 'buffer', None) is not None
         set_printed(step, lvl)
-        if not lvl == 'E':
+        if not lvl == 'E' and not buffered:
             if not step == 'uninstall':
                 if not after_warning():
                     if step == 'scan':
@@ -68,7 +125,7 @@ def print_term(step, lvl, message, **kwargs):
         string = f'[{string}'
         if lvl == 'I':
             if not u_input:
-                echo(string)
+                _emit(string)
             else:
                 return input(string)
         else:
@@ -80,44 +137,250 @@ def print_term(step, lvl, message, **kwargs):
             if lvl == 'D':
                 color = 'cyan'
             if not u_input:
-                echo(click.style(string, fg=color))
+                _emit(click.style(string, fg=color))
             else:
                 return input(click.style(string, fg=color))
 
 
+def start_progress(step, uid=None, count='', total=None):
+    """Starts reporting the progress of a backup. In verbose mode, a line is printed for each file. Otherwise, the
+    counters are shown on a single line redrawn PROGRESS_RATE times per second at most, and the lines of the files are
+    only logged. Nothing is drawn in headless mode. When the output is buffered (--jobs), the lines of the files are
+    only logged too, even in verbose mode: the buffer only holds the status lines of the project. When the output
+    is not a terminal, only the final counters are printed
+    :param step: text, the step of the backup ('arch', 'copy', 'dedu')
+    :param uid: text, optional, the uid of the current execution
+    :param count: text, the current count out of a total of backups to process
+    :param total: number of files to process if known, used to compute the ETA
+    :return: dictionary/object representing the progress
+    """
+    buffered = getattr(_output, 'buffer', None) is not None
+    shown = not state('headless') and not state('verbose') and not buffered
+    return {
+        'step': step,
+        'uid': uid,
+        'count': count,
+        'total': total,
+        'files': 0,
+        'bytes': 0,
+        'started': time.monotonic(),
+        'drawn': 0,
+        'verbose': state('verbose') and not buffered,
+        'shown': shown,
+        'live': shown and sys.stdout.isatty()
+    }
+
+
+def _progress_line(progress):
+    """
+    :return: The line showing the counters of a progress
+    """
+    elapsed = max(time.monotonic() - progress['started'], 1e-6)
+    count = f'[{progress["count"]}]' if progress['count'] else ''
+    line = f'[{progress["step"]}]{count}[I] {progress["files"]} files - {progress["bytes"] / 1048576:.1f}MB' \
+           f' - {progress["files"] / elapsed:.0f} files/s - {progress["bytes"] / 1048576 / elapsed:.1f}MB/s'
+    if progress['total'] and progress['files']:
+        remaining = elapsed * (progress['total'] - progress['files']) / progress['files']
+        line += f' - ETA {int(remaining // 60):02d}:{int(remaining % 60):02d}'
+    return line
+
+
+def _draw_progress(progress, end=''):
+    """Redraws the progress line in place, only used when the output is a terminal"""
+    global _progress_shown
+    line = _progress_line(progress)
+    with output_lock:
+        sys.stdout.write(f'\r{line}\033[K{end}')
+        sys.stdout.flush()
+        _progress_shown = not end
+
+
+def update_progress(progress, message, size=0, files=1):
+    """Reports a processed file
+    :param progress: dictionary/object returned by start_progress()
+    :param message: text, the line describing the file. Printed in verbose mode, logged in any case. None to skip it
+    :param size: number of bytes of the file
+    :param files: number of files processed, 0 for a folder
+    """
+    progress['files'] += files
+    progress['bytes'] += size
+    if message is not None:
+        print_term(progress['step'], 'I', message, progress['uid'], cnt=progress['count'], quiet=not progress['verbose'])
+    if progress['live']:
+        now = time.monotonic()
+        if now - progress['drawn'] >= 1 / PROGRESS_RATE:
+            progress['drawn'] = now
+            _draw_progress(progress)
+
+
+def end_progress(progress):
+    """Leaves the final counters on the progress line, the next stat line replaces it like it replaces the file lines.
+    When the output is not a terminal, the counters are printed as a plain line, without any control sequence"""
+    if progress['shown']:
+        if progress['live']:
+            _draw_progress(progress, '\n')
+        else:
+            _emit(_progress_line(progress))
+        set_printed(progress['step'], 'I')
+
+
+def get_session():
+    """
+    :return: The requests session shared by all the uploads of the current run, so that connections are reused
+    """
+    global _session
+    import requests
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+    return _session
+
+
+class MultipartBody:
+    """Streaming multipart/form-data body: the file is read by blocks of a fixed size while the request is sent.
+    Its length is known up front, so that requests sends a Content-Length instead of a chunked body.
+    When the file is read from a spool, the body is sent chunked by iterating over it: iter(body)"""
+
+    def __init__(self, archive_path, fields, buffer_size, on_progress=None, spool=None, max_size=None):
+        self.archive_path = archive_path
+        self.buffer_size = buffer_size
+        self.on_progress = on_progress
+        self.spool = spool
+        self.max_size = max_size
+        from uuid import uuid4
+        self.boundary = uuid4().hex
+        self.file_size = os.path.getsize(archive_path) if spool is None else 0
+        head = ''.join(
+            f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+            for name, value in fields.items()
+        )
+        filename = os.path.basename(archive_path).replace('"', '%22')
+        head += f'--{self.boundary}\r\n' \
+                f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n' \
+                f'Content-Type: application/octet-stream\r\n\r\n'
+        self.head = head.encode()
+        self.tail = f'\r\n--{self.boundary}--\r\n'.encode()
+        self.content_type = f'multipart/form-data; boundary={self.boundary}'
+
+    def __len__(self):
+        return len(self.head) + self.file_size + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        if self.spool is not None:
+            from tools.spool import read_spool
+            yield from read_spool(self.spool, self.buffer_size, self.max_size)
+        else:
+            sent = 0
+            with open(self.archive_path, 'rb') as read_file:
+                for block in iter(lambda: read_file.read(self.buffer_size), b''):
+                    yield block
+                    sent += len(block)
+                    if self.on_progress:
+                        self.on_progress(sent, self.file_size)
+        yield self.tail
+
+
+def print_progress(sent, total):
+    """Prints the progress of an upload on a single line"""
+    if not state('headless'):
+        with output_lock:
+            sys.stdout.write(f'\r⬆ Uploading... {sent * 100 // max(total, 1)}% ({sent / 1048576:.1f}/{total / 1048576:.1f}MB)')
+            sys.stdout.flush()
+
+
 def upload_archive(archive_path, expire_time):
-    """Upload a file to file.io with a spinner animation.
+    """Upload a file to file.io, the file is streamed by blocks and the upload is retried with a backoff if it fails.
     param: archive_path (str): The path to the file to be uploaded.
     param: expire_time (str): Expiration time in ISO 8601 or duration format (e.g., '14d').
-    returns: Response: The response from the file.io API.
+    returns: Response: The response from the file.io API, or None if every attempt failed.
     """
-    url = 'https://file.io'
-    stop_event = threading.Event()  # Event to signal the spinner to stop
+    import requests
+    upload_settings = get_settings()['upload_default']
+    retries = upload_settings['retries']
+    # The progress line would mix up with the lines of the other projects when they are processed concurrently,
+    # and is only redrawn in place on a terminal
+    live = getattr(_output, 'buffer', None) is None and sys.stdout.isatty()
 
-    # Start the spinner in a separate thread
-    spinner_thread = threading.Thread(target=spinner_animation, args=(stop_event, 'Uploading...'))
-    spinner_thread.start()
+    for attempt in range(retries + 1):
+        body = MultipartBody(
+            archive_path, {'expires': expire_time},
+            upload_settings['buffer_size'],
+            print_progress if live else None
+        )
+        error = None
+        try:
+            response = get_session().post(
+                upload_settings['url'], data=body,
+                headers={'Content-Type': body.content_type},
+                timeout=upload_settings['timeout']
+            )
+            # Server side errors and rate limiting are worth another try, other responses are final
+            if response.status_code < 500 and response.status_code != 429:
+                return response
+            error = f'HTTP {response.status_code}'
+        except requests.RequestException as exc:
+            error = exc
+        finally:
+            if live and not state('headless'):
+                with output_lock:
+                    sys.stdout.write('\r\033[K')
+                    sys.stdout.flush()
 
+        if attempt < retries:
+            delay = upload_settings['backoff'] * 2 ** attempt
+            print_term('uplo', 'W', f'Upload failed ({error}), retrying in {delay}s ({attempt + 1}/{retries})')
+            time.sleep(delay)
+        else:
+            print_term('uplo', 'E', f'Upload failed ({error})')
+    return None
+
+
+def upload_spool(spool, expire_time, max_size=None):
+    """Uploads an archive while it is being written, the request body is sent chunked as the archive grows.
+    If the streamed upload fails, the archive is uploaded again once it is complete, with upload_archive()
+    param: spool (dict): The spool of the archive, returned by open_spool()
+    param: expire_time (str): Expiration time in ISO 8601 or duration format (e.g., '14d').
+    param: max_size (int): The upload is given up if the archive grows past this size.
+    returns: Response: The response from the file.io API, or None if the upload failed.
+    """
+    import requests
+    from tools.spool import SpoolError, wait_spool
+    upload_settings = get_settings()['upload_default']
+    body = MultipartBody(spool['path'], {'expires': expire_time}, upload_settings['buffer_size'], spool=spool, max_size=max_size)
     try:
-        # Perform the upload
-        with open(archive_path, 'rb') as file:
-            files = {'file': file}
-            data = {'expires': expire_time}
-            response = requests.post(url, files=files, data=data)
-    finally:
-        # Stop the spinner once the request completes
-        stop_event.set()
-        spinner_thread.join()  # Wait for the spinner thread to exit
+        response = get_session().post(
+            upload_settings['url'], data=iter(body),
+            headers={'Content-Type': body.content_type},
+            timeout=upload_settings['timeout']
+        )
+        if response.status_code < 500 and response.status_code != 429:
+            return response
+        error = f'HTTP {response.status_code}'
+    except SpoolError as exc:
+        # The archive failed or is too large, there is nothing left to upload
+        if not spool['failed']:
+            print_term('uplo', 'E', str(exc))
+        return None
+    except requests.RequestException as exc:
+        error = exc
+        if isinstance(exc.__context__, SpoolError):
+            if not spool['failed']:
+                print_term('uplo', 'E', str(exc.__context__))
+            return None
 
-    return response
+    if not wait_spool(spool):
+        return None
+    print_term('uplo', 'W', f'Streamed upload failed ({error}), uploading the complete archive')
+    return upload_archive(spool['path'], expire_time)
 
 
 def time_until_expiry(expiry_date_str):
     # Parse the expiration date string with UTC timezone
-    expiry_date = datetime.strptime(expiry_date_str, '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=pytz.UTC)
+    expiry_date = datetime.strptime(expiry_date_str, EXPIRY_FORMAT).replace(tzinfo=timezone.utc)
 
     # Get the current date and time with UTC timezone
-    current_date = datetime.now(pytz.UTC)
+    current_date = datetime.now(timezone.utc)
 
     # Calculate the difference
     difference = expiry_date - current_date
@@ -5,68 +5,374 @@
 
 from tools.state import state
 from tools.piputils import print_term
+from tools.exclusions import compile_terms, is_excluded
+from tools.content import search_file
 import tools.utils as utils
 from os.path import exists
-import glob
+from collections import deque
+from fnmatch import fnmatch
+import threading
+import hashlib
+import math
+import json
 import os
-import re
 
 
-def frameworks_processing(rules, proj_fld):
+# Format of the cached rule index, bumped when the content of the index changes
+INDEX_VERSION = 2
+# Format of the detection cache, bumped when the detection logic changes
+DETECTION_VERSION = 1
+# Guards the detection cache
+_detection_lock = threading.Lock()
+
+
+def compile_rule_index(rules):
+    """Compiles the rules into lookup tables, so that each directory entry met during the walk is classified
+    with a few dict lookups instead of looping over every rule and criterion.
+    :param rules: object containing the framework and vanilla rules
+    :return: a JSON-serializable dictionary representing the rule index
+    """
+    dep_folders = sorted(utils.get_dependency_folders(rules['frameworks'] + rules['vanilla']))
+    index = {
+        'groups': [],  # Exclusion terms, shared by the rules that have the same exclusions
+        'rule_groups': {'frameworks': [], 'vanilla': []},  # Exclusion group of each rule, by rule position
+        'folders': {},  # Folder name -> [framework rule position, folder criterion position]
+        'files': {},  # File name -> [framework rule position, file criterion position]
+        'extensions': {},  # Last suffix -> [vanilla rule position, extension position, literal ending]
+        'ext_globs': []  # [vanilla rule position, extension position, pattern] for the patterns that aren't plain endings
+    }
+
+    for rule_type in ('frameworks', 'vanilla'):
+        for _rule in rules[rule_type]:
+            exclude = _rule['actions']['exclude']
+            terms = sorted(
+                set(exclude.get('files') or []) | set(exclude.get('folders') or [])
+                | set(exclude.get('dep_folders') or []) | set(dep_folders)
+            )
+            if terms not in index['groups']:
+                index['groups'].append(terms)
+            index['rule_groups'][rule_type].append(index['groups'].index(terms))
+
+    for rule_idx, _rule in enumerate(rules['frameworks']):
+        for crit_idx, folder in enumerate(_rule['detect']['folders']):
+            index['folders'].setdefault(folder['name'], []).append([rule_idx, crit_idx])
+        for crit_idx, file in enumerate(_rule['detect']['files']):
+            for name in file['names']:
+                index['files'].setdefault(name, []).append([rule_idx, crit_idx])
+
+    for rule_idx, _rule in enumerate(rules['vanilla']):
+        for ext_idx, ext_elem in enumerate(_rule['detect']['extensions']):
+            for ext in ext_elem['names']:
+                literal = ext[1:]
+                if ext.startswith('*') and '.' in literal and not any(char in literal for char in '*?['):
+                    suffix = literal[literal.rindex('.'):]
+                    index['extensions'].setdefault(suffix, []).append([rule_idx, ext_idx, literal])
+                else:
+                    index['ext_globs'].append([rule_idx, ext_idx, ext])
+
+    return index
+
+
+def get_rule_index():
+    """Gets the compiled index of the rules.json rules. The index is cached into tmp/rules_index.json
+    and is only compiled again when the mtime or the hash of rules.json changes.
+    :return: a dictionary representing the rule index
+    """
+    rules = utils.get_rules()
+    signature = utils.get_rules_signature()
+    tmp_fld = f'{utils.get_setup_fld()}/tmp'
+    index_path = f'{tmp_fld}/rules_index.json'
+
+    try:
+        with open(index_path, 'r') as read_index:
+            cached = json.load(read_index)
+        if (
+            cached.get('version') == INDEX_VERSION
+            and cached['mtime'] == signature['mtime']
+            and cached['sha256'] == signature['sha256']
+        ):
+            return cached['index']
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+
+    if state('debug'): print_term('scan:index', 'D', 'Compiling the rule index')
+    index = compile_rule_index(rules)
+    try:
+        os.makedirs(tmp_fld, exist_ok=True)
+        utils.write_atomic(index_path, json.dumps({**signature, 'version': INDEX_VERSION, 'index': index}))
+    except OSError as e:
+        print_term('scan', 'W', f'Could not cache the rule index: {e}')
+    return index
+
+
+def get_fingerprint(rules, proj_fld, index):
+    """Computes a cheap fingerprint of what the detection depends on: the rules, the mtime and size of the
+    entries at the root of the project, and of the marker files and folders the framework rules look for at the root.
+    Adding or removing an entry at the root changes the mtime of the project folder, which is part of it too
+    :param rules: object containing the framework and vanilla rules
+    :param proj_fld: text, the project folder
+    :param index: the compiled index of the rules
+    :return: text, the fingerprint
+    """
+    names = set(index['files']) | set(index['folders'])
+    for _rule in rules['frameworks']:
+        for folder in _rule['detect']['folders']:
+            names.update(f'{folder["name"]}/{file}' for file in folder['files'])
+    try:
+        with os.scandir(proj_fld) as iterator:
+            names.update(entry.name for entry in iterator)
+    except OSError:
+        pass
+
+    fingerprint = hashlib.sha256(json.dumps([
+        DETECTION_VERSION, utils.get_rules_signature()['sha256'], utils.get_settings()['scan']
+    ]).encode())
+    for name in sorted(names | {'.'}):
+        try:
+            stat = os.stat(f'{proj_fld}/{name}')
+            fingerprint.update(f'{name}:{stat.st_mtime_ns}:{stat.st_size}\n'.encode())
+        except OSError:
+            fingerprint.update(f'{name}:-\n'.encode())
+    return fingerprint.hexdigest()
+
+
+def _read_detection_cache(cache_path):
+    try:
+        with open(cache_path, 'r') as read_cache:
+            cache = json.load(read_cache)
+        if cache.get('version') == DETECTION_VERSION:
+            return cache
+    except (FileNotFoundError, ValueError):
+        pass
+    return {'version': DETECTION_VERSION, 'projects': {}}
+
+
+def get_cached_detection(rules, proj_fld, fingerprint):
+    """Gets the rules detected during a previous run, if the project didn't change since then.
+    The detection cache is kept into tmp/detection_cache.json
+    :param rules: object containing the framework and vanilla rules
+    :param proj_fld: text, the project folder
+    :param fingerprint: text, the current fingerprint of the project, returned by get_fingerprint()
+    :return: the list of the detected rules, as auto_detect() returns them, or None
+    """
+    cache = _read_detection_cache(f'{utils.get_setup_fld()}/tmp/detection_cache.json')
+    cached = cache['projects'].get(os.path.abspath(proj_fld))
+    if not cached or cached['fingerprint'] != fingerprint:
+        return None
+    detected = []
+    for rule_type, name, total in cached['rules']:
+        _rule = next((_rule for _rule in rules[rule_type] if _rule['name'] == name), None)
+        if _rule is None:
+            return None
+        _rule['total'] = total
+        detected.append(_rule)
+    return detected
+
+
+def store_detection(rules, proj_fld, fingerprint, detected):
+    """Stores the rules detected for a project into the detection cache. The projects that don't exist anymore
+    are removed from the cache
+    :param rules: object containing the framework and vanilla rules
+    :param proj_fld: text, the project folder
+    :param fingerprint: text, the fingerprint of the project computed before the scan
+    :param detected: list of the detected rules, taken from rules
+    """
+    tmp_fld = f'{utils.get_setup_fld()}/tmp'
+    cache_path = f'{tmp_fld}/detection_cache.json'
+    # Rule names may be shared by a framework and a vanilla rule, the detected rules are the objects of the ruleset
+    frameworks = {id(_rule) for _rule in rules['frameworks']}
+    with _detection_lock:
+        cache = _read_detection_cache(cache_path)
+        cache['projects'] = {path: cached for path, cached in cache['projects'].items() if os.path.isdir(path)}
+        cache['projects'][os.path.abspath(proj_fld)] = {
+            'fingerprint': fingerprint,
+            'rules': [
+                ['frameworks' if id(_rule) in frameworks else 'vanilla', _rule['name'], _rule['total']]
+                for _rule in detected
+            ]
+        }
+        try:
+            os.makedirs(tmp_fld, exist_ok=True)
+            # Other shlerp processes may write the cache too, the last rename wins
+            utils.write_atomic(cache_path, json.dumps(cache))
+        except OSError as e:
+            print_term('scan', 'W', f'Could not cache the detected rules: {e}')
+
+
+def get_stop_check(approx):
+    """Builds the early termination test of the approximate scan. The scan stops when the file budget is spent, or when:
+    - no new vanilla rule has been met for long enough: a rule matching at least min_share of the files would have been
+    met with the given confidence (the odds of missing it over n files are (1 - min_share) ** n)
+    - and the leading rule can't be overtaken: the gap between the shares of files matched by the two leading rules
+    exceeds twice the Hoeffding bound for this number of files
+    :param approx: dictionary/object holding the "approximate" scan settings
+    :return: a function taking the number of files counted, the number of files counted when the last new rule was met
+    and the number of files matched by each rule. Returns True if the scan can stop
+    """
+    risk = 1 - approx['confidence']
+    stable_files = math.ceil(math.log(risk) / math.log(1 - approx['min_share']))
+
+    def should_stop(counted, last_new, hits):
+        if counted >= approx['file_budget']:
+            return True
+        if not counted or counted - last_new < stable_files:
+            return False
+        leading = sorted(hits.values(), reverse=True)[:2] + [0]
+        bound = math.sqrt(math.log(2 / risk) / (2 * counted))
+        return (leading[0] - leading[1]) / counted > 2 * bound
+    return should_stop
+
+
+def walk_project(rules, proj_fld, index=None):
+    """Walks the project folder once with os.scandir() and scores every framework and vanilla rule on the way.
+    Dependency folders are pruned as soon as they are met, so their content is never listed.
+    When the approximate scan is enabled in the settings, the walk is breadth-first, only a sample of the files of very
+    wide folders is counted, and the walk stops as soon as the vanilla scores are settled. Marker files are shallow,
+    the framework rules are not affected unless their criteria sit deep in the project
+    :param rules: object containing the framework and vanilla rules
+    :param proj_fld: text, the folder we want to process
+    :param index: optional, the compiled index of the rules. Compiled on the fly if not provided
+    :return: a dictionary holding the score of each framework and vanilla rule, by rule name, and the number of files
+    that have been looked at
+    """
+    if index is None:
+        index = compile_rule_index(rules)
+    scores = {
+        'frameworks': {_rule['name']: 0 for _rule in rules['frameworks']},
+        'vanilla': {_rule['name']: 0 for _rule in rules['vanilla']},
+        'files': 0
+    }
+    fw_groups = index['rule_groups']['frameworks']
+    v_groups = index['rule_groups']['vanilla']
+    # Files searched for a pattern are only read up to this size
+    max_bytes = utils.get_settings()['scan']['pattern_max_bytes']
+    approx = utils.get_settings()['scan']['approximate']
+    approx = approx if approx['enabled'] else None
+    should_stop = get_stop_check(approx) if approx else None
+    # Approximate scan: files counted by the extension counters, files counted when the last new vanilla rule was met,
+    # and number of files matched by each vanilla rule
+    counted = last_new = 0
+    hits = {}
+
+    # One exclusion matcher per group. Entries are tested one path segment at a time, as the folders
+    # they are in have already been tested when they were met
+    matchers = [compile_terms(terms) for terms in index['groups']]
+
+    # Each stack entry holds a folder, its path relative to the project, the exclusion groups for which it is
+    # not excluded and whether it sits under a hidden folder (hidden folders are not crawled by the extension counters)
+    stack = deque([(proj_fld, '', set(range(len(matchers))), False)])
+    pop = stack.popleft if approx else stack.pop
+    while stack:
+        if approx and should_stop(counted, last_new, hits):
+            print_term('scan', 'I', f'Approximate scan: scores settled after {counted} files')
+            break
+        root, rel_root, active, hidden = pop()
+        try:
+            with os.scandir(root) as iterator:
+                entries = list(iterator)
+        except OSError:
+            continue
+        # Approximate scan: only one file out of step is counted in very wide folders, its weight is multiplied by step
+        step = 1
+        if approx and len(entries) > approx['sample_size']:
+            step = math.ceil(len(entries) / approx['sample_size'])
+
+        for position, entry in enumerate(entries):
+            name = entry.name
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            # Marker files are never skipped by the sampling
+            if step > 1 and not is_dir and position % step and name not in index['files']:
+                continue
+            rel_name = f'{rel_root}/{name}' if rel_root else name
+            # Exclusion groups for which this entry is still relevant
+            entry_active = {group for group in active if not is_excluded(matchers[group], rel_name, name)}
+            if not entry_active:
+                continue
+
+            if not is_dir:
+                scores['files'] += 1
+            if is_dir:
+                if not entry.is_symlink():
+                    stack.append((entry.path, rel_name, entry_active, hidden or name.startswith('.')))
+
+                # Check for folders defined in the framework rules
+                for rule_idx, crit_idx in index['folders'].get(name, ()):
+                    if fw_groups[rule_idx] not in entry_active:
+                        continue
+                    _rule = rules['frameworks'][rule_idx]
+                    folder = _rule['detect']['folders'][crit_idx]
+                    if not folder['files']:
+                        scores['frameworks'][_rule['name']] += 1
+                        if state('debug'): print_term('scan:walk', 'D', f'Matched folder: {entry.path}')
+                    else:
+                        match = True
+                        for file in folder['files']:
+                            if not exists(os.path.join(entry.path, file)):
+                                match = False
+                        if match:
+                            scores['frameworks'][_rule['name']] += 1
+                            if state('debug'): print_term('scan:walk', 'D', f'Matched all files in folder: {entry.path}')
+            else:
+                # Check for files defined in the framework rules
+                criteria = [
+                    (rules['frameworks'][rule_idx], crit_idx) for rule_idx, crit_idx in index['files'].get(name, ())
+                    if fw_groups[rule_idx] in entry_active
+                ]
+                patterns = [_rule['detect']['files'][crit_idx].get('pattern', None) for _rule, crit_idx in criteria]
+                # The file is read once for all the rules that look for a pattern in it
+                found = search_file(entry.path, filter(None, patterns), max_bytes) if any(patterns) else set()
+                for (_rule, crit_idx), pattern in zip(criteria, patterns):
+                    if pattern:
+                        if pattern in found:
+                            scores['frameworks'][_rule['name']] += 1
+                            if state('debug'): print_term('scan:walk', 'D', f'Matched pattern in file: {entry.path}')
+                    else:
+                        scores['frameworks'][_rule['name']] += 1
+                        if state('debug'): print_term('scan:walk', 'D', f'Matched file: {entry.path}')
+
+            # Extension counters
+            if not hidden and not name.startswith('.'):
+                matched = []
+                dot = name.rfind('.')
+                if dot != -1:
+                    for rule_idx, ext_idx, literal in index['extensions'].get(name[dot:], ()):
+                        if name.endswith(literal):
+                            matched.append((rule_idx, ext_idx))
+                for rule_idx, ext_idx, pattern in index['ext_globs']:
+                    if fnmatch(name, pattern):
+                        matched.append((rule_idx, ext_idx))
+                matched_rules = set()
+                for rule_idx, ext_idx in matched:
+                    if v_groups[rule_idx] in entry_active:
+                        _rule = rules['vanilla'][rule_idx]
+                        scores['vanilla'][_rule['name']] += _rule['detect']['extensions'][ext_idx]['weight'] * step
+                        matched_rules.add(_rule['name'])
+                        if state('debug'): print_term('scan:walk', 'D', f'Matched: {entry.path} for rule: {_rule["name"]}')
+                if approx and not is_dir:
+                    counted += 1
+                    for rule_name in matched_rules:
+                        if rule_name not in hits:
+                            last_new = counted
+                        hits[rule_name] = hits.get(rule_name, 0) + 1
+
+    return scores
+
+
+def frameworks_processing(rules, proj_fld, scores=None):
     """Process the project folder to detect frameworks based on the provided rules.
     :param rules: object list containing framework rules
     :param proj_fld: text, the folder we want to process
+    :param scores: optional, the result of walk_project() if the project has already been walked
     :return: a list of matched framework rules
     """
     _fw_leads = []
-    dep_folders = utils.get_dependency_folders(rules['frameworks'] + rules['vanilla'])
+    if scores is None:
+        scores = walk_project(rules, proj_fld)
     for _rule in rules['frameworks']:
-        exclusions = _rule['actions']['exclude']
-        if state('debug'): print_term('scan:fram', 'D', f'Processing rule: {_rule["name"]}')
-        total_matches = 0
-
-        # Use os.walk() to traverse the project folder and its subfolders
-        for root, dirs, files in os.walk(proj_fld):
-            # Exclude dependency folders from dirs
-            dirs[:] = [d for d in dirs if not excluded(os.path.join(root, d), exclusions, dep_folders)]
-
-            # Check for folders defined in the rule
-            for folder in _rule['detect']['folders']:
-                name = folder['name']
-                if name in dirs:
-                    folder_path = os.path.join(root, name)
-                    if not excluded(folder_path, exclusions, dep_folders):
-                        if not folder['files']:
-                            total_matches += 1
-                            if state('debug'): print_term('scan:fram', 'D', f'Matched folder: {folder_path}')
-                        else:
-                            match = True
-                            for file in folder['files']:
-                                if not exists(os.path.join(folder_path, file)):
-                                    match = False
-                            if match:
-                                total_matches += 1
-                                if state('debug'): print_term('scan:fram', 'D', f'Matched all files in folder: {folder_path}')
-                    else:
-                        continue
-
-            # Check for files defined in the rule
-            for file in _rule['detect']['files']:
-                names = file['names']
-                pattern = file.get('pattern', None)
-                for name in names:
-                    if name in files:
-                        file_path = os.path.join(root, name)
-                        if not excluded(file_path, exclusions, dep_folders):
-                            if pattern:
-                                with open(file_path, 'r') as file_content:
-                                    content = file_content.read()
-                                    if re.search(pattern, content):
-                                        total_matches += 1
-                                        if state('debug'): print_term('scan:fram', 'D', f'Matched pattern in file: {file_path}')
-                            else:
-                                total_matches += 1
-                                if state('debug'): print_term('scan:fram', 'D', f'Matched file: {file_path}')
+        total_matches = scores['frameworks'][_rule['name']]
 
         _rule["total"] = total_matches
         if state('debug'): print_term('scan:fram', 'D', f'Total score for rule {_rule["name"]}: {total_matches}')
@@ -105,7 +411,7 @@ def frameworks_processing(rules, proj_fld):
     return utils.elect(_fw_leads)
 
 
-def vanilla_processing(_rules, proj_fld):
+def vanilla_processing(_rules, proj_fld, scores=None):
     """This function is scanning the project folder to backup and compares its content with the rules
     defined in the vanilla section of the rules file.
     :return: A list containing the "vanilla" rule that matches the most with the project, can return
@@ -114,7 +420,7 @@ def vanilla_processing(_rules, proj_fld):
     leads = []
     print_term('scan', 'I', 'Running deep scan...')
     if state('debug'): print_term('scan:vani', 'D', f'Starting vanilla processing for project folder: {proj_fld}')
-    scored_v_rules = deep_scan(proj_fld, _rules)
+    scored_v_rules = deep_scan(proj_fld, _rules, scores)
     for svr in scored_v_rules:
         if svr['total']:
             leads.append(svr)
@@ -129,36 +435,19 @@ def vanilla_processing(_rules, proj_fld):
     return leads
 
 
-def deep_scan(proj_fld, rules):
-    """Crawl the project to find files matching the extensions we provide to this function
+def deep_scan(proj_fld, rules, scores=None):
+    """Adds the extension scores computed by walk_project() to the vanilla rules
     :param proj_fld: text, the folder we want to process
     :param rules: object list containing languages names, extensions to crawl and weights
+    :param scores: optional, the result of walk_project() if the project has already been walked
     :return: an updated list with some more weight (hopefully)
     """
-    dep_folders = utils.get_dependency_folders(rules['frameworks'] + rules['vanilla'])
+    if scores is None:
+        scores = walk_project(rules, proj_fld)
     for rule in rules['vanilla']:
-        exclusions = rule['actions']['exclude']
         if 'total' not in rule.keys():
             rule['total'] = 0
-        for ext_elem in rule['detect']['extensions']:
-            for ext in ext_elem['names']:
-                if state('debug'): print_term('scan:iglob', 'D', f'Processing extension: {ext} for rule: {rule["name"]}')
-                for file_path in glob.iglob(f'{proj_fld}/**/*{ext}', recursive=True):
-                    if not excluded(file_path, exclusions, dep_folders):
-                        rule['total'] += ext_elem['weight']
-                        if state('debug'): print_term('scan:iglob', 'D', f'Matched: {file_path} for rule: {rule["name"]}, updated total: {rule["total"]}')
-                    else:
-                        if state('debug'): print_term('scan:iglob', 'D', f'Excluded: {file_path} for rule: {rule["name"]}')
-        if state('debug'): print_term('scan:iglob', 'D', f'Total for rule {rule["name"]}: {rule["total"]}')
+        rule['total'] += scores['vanilla'][rule['name']]
+        if state('debug'): print_term('scan:deep', 'D', f'Total for rule {rule["name"]}: {rule["total"]}')
     return rules['vanilla']
 
-
-def excluded(path, exclusions, dep_folders):
-    """Check if a path should be excluded based on exclusions and dependency folders."""
-    for exclusion in exclusions:
-        if exclusion in path:
-            return True
-    for dep_folder in dep_folders:
-        if dep_folder in path:
-            return True
-    return False
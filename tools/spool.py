@@ -0,0 +1,84 @@
+###############################################################
+# This file features the spool used to upload an archive while
+# it is being written. The archive file itself is the spool: the
+# writer publishes how far the file is final, and the uploader
+# reads it from there (mostly from the page cache).
+
+import threading
+import os
+
+
+class SpoolError(RuntimeError):
+    """Raised by the reader when the archive can't be uploaded as it is written"""
+
+
+def open_spool(path):
+    """Creates the archive file and the spool that goes with it
+    :param path: text, path of the archive that is about to be written
+    :return: dictionary/object representing the spool
+    """
+    open(path, 'wb').close()
+    return {
+        'path': path,
+        # Offset up to which the file won't change anymore. None means that the file is only appended to,
+        # everything that is on disk is final
+        'committed': None,
+        'done': False,
+        'failed': False,
+        'cond': threading.Condition()
+    }
+
+
+def publish(spool, committed=None, done=False, failed=False):
+    """Tells the reader how far the archive is final
+    :param spool: dictionary/object returned by open_spool()
+    :param committed: number, offset up to which the file won't change anymore
+    :param done: True once the archive is complete, committed is then the size of the archive
+    :param failed: True if the archive couldn't be written, the reader stops
+    """
+    with spool['cond']:
+        if committed is not None:
+            spool['committed'] = committed
+        spool['done'] = spool['done'] or done
+        spool['failed'] = spool['failed'] or failed
+        spool['cond'].notify_all()
+
+
+def wait_spool(spool):
+    """Waits for the writer to be done
+    :return: True if the archive has been written successfully
+    """
+    with spool['cond']:
+        spool['cond'].wait_for(lambda: spool['done'] or spool['failed'])
+        return not spool['failed']
+
+
+def read_spool(spool, buffer_size, max_size=None):
+    """Reads the archive as it is written
+    :param spool: dictionary/object returned by open_spool()
+    :param buffer_size: maximum size of the blocks
+    :param max_size: optional, the reader stops if the archive grows past this size
+    :return: yields the blocks of the archive, raises SpoolError if the archive failed or is too large
+    """
+    sent = 0
+    with open(spool['path'], 'rb') as read_file:
+        while True:
+            with spool['cond']:
+                while True:
+                    if spool['failed']:
+                        raise SpoolError('The archive could not be written')
+                    limit = spool['committed']
+                    if limit is None:
+                        limit = os.fstat(read_file.fileno()).st_size
+                    if limit > sent or spool['done']:
+                        break
+                    # Appended data isn't notified, the file size is checked again periodically
+                    spool['cond'].wait(timeout=0.2)
+            if max_size is not None and limit > max_size:
+                raise SpoolError(f'File size is too big: {limit / 1024 ** 3:.2f} GB')
+            if sent >= limit:
+                return
+            read_file.seek(sent)
+            block = read_file.read(min(buffer_size, limit - sent))
+            sent += len(block)
+            yield block
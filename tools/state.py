@@ -1,18 +1,24 @@
 from tools.utils import get_settings
+import threading
 
+_settings = get_settings()
 _state = {
     'uid': '', # UID that represents the current execution. Not meant to be changed after its initial initialization
     'headless': False,
-    'debug': get_settings()['debug_scan'],
-    'verbose': get_settings()['verbose'] if not get_settings()['debug_scan'] else True, # Defines if the printing function should overwrite the previous term line or not
+    'debug': _settings['debug_scan'],
+    'verbose': _settings['verbose'] if not _settings['debug_scan'] else True, # Defines if the printing function should overwrite the previous term line or not
     'printed': [], # Represents the step we're in, will be used if a SIGINT occurs
     'backed_up': [], # Lists successfully backed up projects path
     'failures': [], # Lists the projects that couldn't be backed up
     'ad_failures': [], # Lists the paths for which the autodetection failed
     'upload_failures': [], # Lists the paths for which the upload failed
+    'metrics': {}, # Timing & throughput of each stage (scan, archive, copy, dedup, upload), by project path
     'total': 0 # Total number of projects to backup
 }
 
+# Guards the setters, --jobs processes projects concurrently
+_lock = threading.Lock()
+
 
 # Getters
 
@@ -28,6 +34,10 @@ def after_warning():
     return _state['printed'][-1]['lvl'] == 'W'
 
 
+def get_metrics():
+    return _state['metrics']
+
+
 def x_consecutive_entries_in_step(x, step):
     count = 0
     if len(_state['printed']) >= x:
@@ -45,22 +55,47 @@ def x_consecutive_entries_in_step(x, step):
 # Setters
 
 def set_state(key, value):
-    _state[key] = value
+    with _lock:
+        _state[key] = value
 
 
 def append_state(key, value):
-    _state[key].append(value)
+    with _lock:
+        _state[key].append(value)
 
 
 def incr_state(key, amount=1):
-    _state[key] += amount
+    with _lock:
+        _state[key] += amount
 
 
 def set_printed(step, lvl):
     entry = {'step': step, 'lvl': lvl}
-    _state['printed'].append(entry)
-    if len(_state['printed']) > 3:
-        _state['printed'].pop(0)
+    with _lock:
+        _state['printed'].append(entry)
+        if len(_state['printed']) > 3:
+            _state['printed'].pop(0)
+
+
+def record_stage(project, stage, wall_time, files=0, bytes_read=0, bytes_written=0, errors=0):
+    """Records the metrics of a stage of a project
+    :param project: text, the path of the project
+    :param stage: text, 'scan', 'archive', 'copy', 'dedup' or 'upload'
+    :param wall_time: number of seconds the stage took
+    :param files: number of files processed
+    :param bytes_read: number of bytes read from the project
+    :param bytes_written: number of bytes written into the backup, or sent by the upload
+    :param errors: number of errors met
+    """
+    with _lock:
+        _state['metrics'].setdefault(project, {})[stage] = {
+            'wall_time': wall_time,
+            'files': files,
+            'bytes_read': bytes_read,
+            'bytes_written': bytes_written,
+            'compression_ratio': bytes_written / bytes_read if bytes_read else None,
+            'errors': errors
+        }
 
 
 def force_verbose():
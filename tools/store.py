@@ -0,0 +1,201 @@
+###############################################################
+# This file features the content-addressed store used by --dedup.
+# Files are split into content-defined chunks, each chunk is
+# written once under its sha256, and each backup is a small index
+# referencing the files it contains.
+
+from tools.utils import write_atomic
+from os.path import exists
+import hashlib
+import mmap
+import json
+import re
+import zlib
+import os
+
+# Content-defined chunking parameters. Files smaller than MIN_CHUNK are stored as a single chunk
+MIN_CHUNK = 16 * 1024
+MAX_CHUNK = 1024 * 1024
+# Cut candidates are found by the regex engine: line ends, and the end of runs of zero bytes.
+# A candidate becomes a cut point if the CRC-32 of the WINDOW bytes before it has its ANCHOR_BITS low bits unset,
+# so the cut points only depend on the content around them and survive insertions earlier in the file
+_ANCHOR = re.compile(rb'\n|\x00(?!\x00)')
+WINDOW = 48
+ANCHOR_BITS = 10
+_ANCHOR_MASK = (1 << ANCHOR_BITS) - 1
+# Content without any suitable candidate (single line minified files, some binaries) is cut by a gear rolling hash:
+# a cut point is where the GEAR_BITS high bits of the hash of the previous 64 bytes are unset. It is computed byte
+# by byte in Python, so it only runs where the candidates found nothing
+GEAR_BITS = 16
+_GEAR_MASK = ((1 << GEAR_BITS) - 1) << (64 - GEAR_BITS)
+_GEAR = [int.from_bytes(hashlib.sha256(bytes([value])).digest()[:8], 'little') for value in range(256)]
+
+
+def get_store_fld(dst):
+    """
+    :param dst: text, the backup destination
+    :return: The path of the store, in the .shlerp folder of the output location
+    """
+    return f'{os.path.dirname(dst)}/.shlerp/store'
+
+
+def _write_once(path, data):
+    """Writes a file under a temporary name then renames it, unless it already exists"""
+    if exists(path):
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_atomic(path, data)
+    return True
+
+
+def _object_path(store_fld, kind, digest):
+    return f'{store_fld}/{kind}/{digest[:2]}/{digest}'
+
+
+def _gear_cut(data, start, end):
+    """Finds the first cut point of the gear rolling hash between two offsets
+    :return: the offset of the cut point, or end if there is none
+    """
+    gear = _GEAR
+    digest = 0
+    # The hash only depends on the last 64 bytes, it is primed with the ones before start
+    offset = max(start - 64, 0)
+    for value in data[offset:start]:
+        digest = ((digest << 1) + gear[value]) & 0xFFFFFFFFFFFFFFFF
+    for offset, value in enumerate(data[start:end], start + 1):
+        digest = ((digest << 1) + gear[value]) & 0xFFFFFFFFFFFFFFFF
+        if not digest & _GEAR_MASK:
+            return offset
+    return end
+
+
+def cut_points(data):
+    """Finds the content-defined cut points of a buffer
+    :param data: bytes-like object (bytes or mmap)
+    :return: yields the end offset of each chunk
+    """
+    size = len(data)
+    pos = 0
+    while pos < size:
+        if size - pos <= MIN_CHUNK:
+            yield size
+            return
+        end = min(pos + MAX_CHUNK, size)
+        cut = None
+        for match in _ANCHOR.finditer(data, pos + MIN_CHUNK, end):
+            anchor = match.end()
+            if not zlib.crc32(data[anchor - WINDOW:anchor]) & _ANCHOR_MASK:
+                cut = anchor
+                break
+        if cut is None:
+            cut = _gear_cut(data, pos + MIN_CHUNK, end)
+        yield cut
+        pos = cut
+
+
+def store_file(store_fld, path, level=6):
+    """Adds a file to the store. Chunks that are already stored are not written again, and files
+    whose content has already been chunked are not scanned again
+    :param store_fld: text, the store folder
+    :param path: text, the file to add
+    :param level: zlib level used to compress the chunks
+    :return: a tuple holding the sha256 of the file, its size and the number of bytes written into the store
+    """
+    file_sha = hashlib.sha256()
+    with open(path, 'rb') as read_file:
+        for block in iter(lambda: read_file.read(1024 * 1024), b''):
+            file_sha.update(block)
+    digest = file_sha.hexdigest()
+    recipe_path = _object_path(store_fld, 'files', digest)
+    size = os.path.getsize(path)
+    if exists(recipe_path):
+        return digest, size, 0
+
+    chunks = []
+    written = 0
+    content_sha = hashlib.sha256()
+    with open(path, 'rb') as read_file:
+        data = mmap.mmap(read_file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        try:
+            size = len(data)
+            pos = 0
+            for cut in cut_points(data):
+                chunk = data[pos:cut]
+                content_sha.update(chunk)
+                chunk_digest = hashlib.sha256(chunk).hexdigest()
+                compressed = zlib.compress(chunk, level)
+                if _write_once(_object_path(store_fld, 'chunks', chunk_digest), compressed):
+                    written += len(compressed)
+                chunks.append(chunk_digest)
+                pos = cut
+        finally:
+            if size:
+                data.close()
+
+    # The file may have changed since it has been hashed, the recipe is stored under the content that got chunked
+    digest = content_sha.hexdigest()
+    recipe = json.dumps(chunks).encode()
+    if _write_once(_object_path(store_fld, 'files', digest), recipe):
+        written += len(recipe)
+    return digest, size, written
+
+
+def write_snapshot(store_fld, name, proj_fld, entries):
+    """Writes the index of a backup. An index is never overwritten: backups made within the same second
+    (same name) get a counter in their name, name-1, name-2...
+    :param store_fld: text, the store folder
+    :param name: text, the name of the backup
+    :param proj_fld: text, the project folder
+    :param entries: list of [rel_name, file digest, size, mode, mtime_ns] lists
+    :return: the path of the index
+    """
+    os.makedirs(f'{store_fld}/snapshots', exist_ok=True)
+    data = json.dumps({'project': proj_fld, 'entries': entries}).encode()
+    attempt = 0
+    while True:
+        index_path = f'{store_fld}/snapshots/{name}{f"-{attempt}" if attempt else ""}.json'
+        try:
+            # The name is reserved by creating the file, concurrent backups can't pick the same one
+            write_index = open(index_path, 'xb')
+        except FileExistsError:
+            attempt += 1
+            continue
+        try:
+            with write_index:
+                write_index.write(data)
+        except BaseException:
+            os.remove(index_path)
+            raise
+        return index_path
+
+
+def restore_store_snapshot(index_path, dst):
+    """Rebuilds a project from the index of a backup made with --dedup
+    :param index_path: text, path of the index, in the snapshots folder of the store
+    :param dst: text, the folder to restore the project into. Must not exist
+    :return: the number of restored files
+    """
+    store_fld = os.path.dirname(os.path.dirname(os.path.abspath(index_path)))
+    with open(index_path, 'r') as read_index:
+        index = json.load(read_index)
+    os.makedirs(dst)
+    for rel_name, digest, size, mode, mtime_ns in index['entries']:
+        file_dst = f'{dst}/{rel_name}'
+        os.makedirs(os.path.dirname(file_dst), exist_ok=True)
+        with open(_object_path(store_fld, 'files', digest), 'r') as read_recipe:
+            chunks = json.load(read_recipe)
+        with open(file_dst, 'wb') as write_file:
+            for chunk_digest in chunks:
+                with open(_object_path(store_fld, 'chunks', chunk_digest), 'rb') as read_chunk:
+                    write_file.write(zlib.decompress(read_chunk.read()))
+        os.chmod(file_dst, mode)
+        os.utime(file_dst, ns=(mtime_ns, mtime_ns))
+    return len(index['entries'])
+
+
+def is_store_snapshot(path):
+    """
+    :return: True if the path is the index of a backup made with --dedup
+    """
+    path = os.path.abspath(path)
+    return path.endswith('.json') and os.path.basename(os.path.dirname(path)) == 'snapshots'
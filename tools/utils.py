@@ -1,22 +1,44 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from os.path import exists
-from uuid import uuid4
+import threading
+import hashlib
 import random
-import subprocess
-import mimetypes
 import re
 import shutil
 import os
 import json
-import glob
 import json
+import copy
 import sys
+import atexit
+import queue
 import time
 
 # Cached data
 
 settings = {}
 app_details = {}
+ruleset = {}
+ruleset_signature = {}
+
+# Supported archive formats and the extension of the files they produce
+ARCHIVE_FORMATS = {
+    'zip': '.zip',
+    'tar.gz': '.tar.gz',
+    'tar.xz': '.tar.xz',
+    'tar.zst': '.tar.zst'
+}
+
+# Logging: records are queued and written in batches by a background thread
+LOG_BATCH_SIZE = 1000
+_log_queue = queue.SimpleQueue()
+_log_lock = threading.Lock()
+_log_writer = None
+# Date of a log entry: [uid:YYYYMMDD#HHMMSS:step] or [YYYYMMDD#HHMMSS:step]
+_LOG_DATE = re.compile(rb'\[(?:[^:\]]*:)?(\d{8})#')
+# Format of the timestamps of the logs and of the backup names, and the last one computed: (epoch second, text)
+DT_FORMAT = '%Y%m%d#%H%M%S'
+_dt_cache = (None, '')
 
 # Getter functions
 
@@ -48,16 +70,42 @@ def get_settings():
     return settings
 
 
-def get_dt():
+def get_rules():
+    """Loads the rules.json file once, and keeps its signature (mtime & hash) so that
+    the data derived from the rules can be cached
+    :return: A copy of the rules, so that callers can score them freely
     """
-    :return: A datetime in string format
+    global ruleset
+    if len(ruleset) == 0:
+        rules_path = f'{get_setup_fld()}/config/rules.json'
+        with open(rules_path, 'rb') as read_rules:
+            raw_rules = read_rules.read()
+        ruleset_signature['mtime'] = os.path.getmtime(rules_path)
+        ruleset_signature['sha256'] = hashlib.sha256(raw_rules).hexdigest()
+        # Filled in one go, so that concurrent scans never see a partially loaded ruleset
+        ruleset.update(json.loads(raw_rules))
+    return copy.deepcopy(ruleset)
+
+
+def get_rules_signature():
     """
-    return str(
-        datetime.now()
-        .isoformat('#', 'seconds')
-        .replace('-', '')
-        .replace(':', '')
-    )
+    :return: A dictionary holding the mtime and the sha256 hash of rules.json
+    """
+    get_rules()
+    return ruleset_signature
+
+
+def get_dt():
+    """Every log line is prefixed with the current time, so it is only formatted once per second
+    :return: A datetime in string format (YYYYMMDD#HHMMSS)
+    """
+    global _dt_cache
+    now = int(time.time())
+    second, text = _dt_cache
+    if second != now:
+        text = time.strftime(DT_FORMAT, time.localtime(now))
+        _dt_cache = (now, text)
+    return text
 
 # Utilities that do not require pip installations
 
@@ -65,6 +113,7 @@ def suid():
     """Generates a short uid
     :return: A unique identifier with a fixed length of 6 characters
     """
+    from uuid import uuid4
     chunks = str(uuid4()).split('-')
     count = 0
     uid = ''
@@ -76,6 +125,27 @@ def suid():
     return uid
 
 
+def write_atomic(path, content):
+    """Writes a file under a temporary name in the same folder then renames it, readers never see a partial file.
+    Each writer (process and thread) gets its own temporary file, the last rename wins. The temporary name is made
+    of digits only, it never matches the files looked up by name in the folder (logs, backups)
+    :param path: text, the file to write
+    :param content: text or bytes, or a function receiving the temporary file opened in binary mode
+    """
+    part_path = f'{os.path.dirname(os.path.abspath(path))}/.{os.getpid()}.{threading.get_ident()}.part'
+    try:
+        with open(part_path, 'wb') as write_file:
+            if callable(content):
+                content(write_file)
+            else:
+                write_file.write(content.encode() if isinstance(content, str) else content)
+        os.replace(part_path, path)
+    except BaseException:
+        if exists(part_path):
+            os.remove(part_path)
+        raise
+
+
 def get_file_size(archive_path):
     try:
         # Get the file size in bytes
@@ -88,19 +158,6 @@ def get_file_size(archive_path):
         return {"error": str(e)}
 
 
-def spinner_animation(stop_event, message):
-    """Function to animate the spinner in a separate thread."""
-    spinner = ['\\', '|', '/', '-']
-    spin_index = 0
-
-    while not stop_event.is_set():  # Keep spinning until the event is set
-        sys.stdout.write(f'\r{spinner[spin_index]} {message}')
-        sys.stdout.flush()
-        spin_index = (spin_index + 1) % len(spinner)
-        time.sleep(0.1)
-    sys.stdout.write('\r')  # Clear the spinner line when done
-
-
 def remove_previous_line():
     """ Removes the previous line from the terminal output and move the cursor"""
     # Move the cursor up by one line
@@ -125,7 +182,62 @@ def iterate_log_name(log_name):
     return f'{base_name}-{integer}.{ext_chunk}'
 
 
-def log(msg, log_type):
+def _dated_line(read_log, pos):
+    """Finds the first dated line starting at or after a given offset of the log file
+    :param read_log: log file, opened in binary mode
+    :param pos: number, offset where to start looking for a line
+    :return: a tuple holding the offset of the line and its date (YYYYMMDD as bytes), or (None, None)
+    """
+    read_log.seek(pos - 1 if pos > 0 else 0)
+    if pos > 0:
+        # Skip the end of the line the offset falls into, unless the offset is at the beginning of a line
+        read_log.readline()
+    while True:
+        start = read_log.tell()
+        line = read_log.readline()
+        if not line:
+            return None, None
+        matched = _LOG_DATE.match(line)
+        # Lines without a date are the continuation of a multi-line message
+        if matched:
+            return start, matched.group(1)
+
+
+def prune_log(log_path, max_age):
+    """Removes the entries older than max_age days from a log file. Entries are time-ordered, so the first
+    entry to keep is found by binary search, then the rest of the file is copied and renamed over the log
+    :param log_path: text, the path of the log file
+    :param max_age: number of days an entry is kept
+    :return: the number of bytes that have been pruned
+    """
+    cutoff = (datetime.now() - timedelta(days=max_age - 1)).strftime('%Y%m%d').encode()
+    with open(log_path, 'rb') as read_log:
+        size = os.fstat(read_log.fileno()).st_size
+        lo, hi = 0, size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start, date = _dated_line(read_log, mid)
+            if start is None or date >= cutoff:
+                hi = mid
+            else:
+                lo = start + 1
+        first_kept = _dated_line(read_log, lo)[0]
+        if first_kept is None:
+            first_kept = size
+        if first_kept == 0:
+            return 0
+
+        read_log.seek(first_kept)
+        write_atomic(log_path, lambda write_log: shutil.copyfileobj(read_log, write_log))
+    return first_kept
+
+
+def resolve_log_file(log_type):
+    """Finds the log file to write into, pruning or rotating the logs beforehand.
+    Called once per log type and per run, by the log writer
+    :param log_type: text, 'exec', 'setup' or 'uninstall'
+    :return: The absolute path of the log file
+    """
     get_settings()
     log_fld = f'{os.path.expanduser("~")}/{settings["rel_logs_path"]}'
     max_size = settings['logging']['no_prune']['max_log_size']
@@ -137,9 +249,11 @@ def log(msg, log_type):
 
     os.makedirs(log_fld, mode=0o775, exist_ok=True)
 
+    # Only the log files themselves: exec.log, exec-1.log... Temporary files and other leftovers are left aside
+    log_name = re.compile(rf'{re.escape(log_type)}(-\d+)?\.log')
     log_files = [
         filename for filename in os.listdir(log_fld)
-        if log_type in filename
+        if log_name.fullmatch(filename)
     ]
 
     if prune:
@@ -163,37 +277,12 @@ def log(msg, log_type):
             for log_file in log_files:
                 shutil.move(f'{log_fld}/{log_file}', f'{log_fld}/old_logs/{log_file}')
 
-            log_file = f'{log_fld}{log_type}.log'
+            log_file = f'{log_type}.log'
 
         elif len(log_files) == 1:
             log_file = log_files[0]
-            # If only one log file, open the file in rw mode and prune the entries that are too old.
-            with open(f'{log_fld}/{log_files[0]}', 'r') as prune_file:
-                now = datetime.now()
-                valid_entries = []
-                prune = False
-                for index, line in enumerate(prune_file.readlines()):
-                    str_date = re.match(r"\[(.*?:)?(.*?):[a-z]+\]", line).group(2)
-                    year = str_date[0:4]
-                    month = str_date[4:6]
-                    day = str_date[6:8]
-                    date = datetime.strptime(f'{year}{month}{day}', '%Y%m%d')
-
-                    days = (now - date).days
-                    if days < max_age:
-                        if index == 1:  # If the first entry is valid, then we don't scan the rest of the file
-                            break
-                        # Else if the date is valid, add the line to the content that we'll write into the log
-                        valid_entries.append(line)
-                    else:
-                        prune = True
-
-                # Then, overwrite the log file with the entries that are recent enough to be kept in the logs.
-                if prune:
-                    with open(f'{log_fld}/{log_files[0]}', 'w') as update_file:
-                        update_file.truncate(0)
-                        for entry in valid_entries:
-                            update_file.write(entry)
+            # If only one log file, prune the entries that are too old
+            prune_log(f'{log_fld}/{log_file}', max_age)
     else:
         #####################
         # Multiple logs
@@ -214,19 +303,63 @@ def log(msg, log_type):
             if log_size >= max_size:
                 log_file = iterate_log_name(log_file)
 
-    with open(f'{log_fld}/{log_file}', 'a+') as write_log:
-        write_log.write(f'{msg}\n')
+    return f'{log_fld}/{log_file}'
+
+
+def _write_logs():
+    """Background writer: writes the queued log records in batches, each log file is opened once per batch"""
+    log_paths = {}
+    while True:
+        records = [_log_queue.get()]
+        # Drain what has been queued in the meantime
+        while len(records) < LOG_BATCH_SIZE:
+            try:
+                records.append(_log_queue.get_nowait())
+            except queue.Empty:
+                break
+        batches = {}
+        stop = False
+        for record in records:
+            if record is None:
+                stop = True
+                continue
+            msg, log_type = record
+            batches.setdefault(log_type, []).append(f'{msg}\n')
+        for log_type, lines in batches.items():
+            try:
+                if log_type not in log_paths:
+                    log_paths[log_type] = resolve_log_file(log_type)
+                with open(log_paths[log_type], 'a+') as write_log:
+                    write_log.write(''.join(lines))
+            except OSError as os_error:
+                print(f'Unable to write the {log_type} log: {os_error}', file=sys.stderr)
+        if stop:
+            return
 
 
-def iglob_hidden(*args, **kwargs):
-    """A glob.iglob that include dot files and hidden files"""
-    """The credits goes to the user polyvertex for this function"""
-    old_ishidden = glob._ishidden
-    glob._ishidden = lambda x: False
-    try:
-        yield from glob.iglob(*args, **kwargs)
-    finally:
-        glob._ishidden = old_ishidden
+def log(msg, log_type):
+    """Queues a log record, it is written by a background thread
+    :param msg: text, the line to log
+    :param log_type: text, 'exec', 'setup' or 'uninstall'
+    """
+    global _log_writer
+    if _log_writer is None:
+        with _log_lock:
+            if _log_writer is None:
+                _log_writer = threading.Thread(target=_write_logs, name='log-writer', daemon=True)
+                _log_writer.start()
+                atexit.register(flush_logs)
+    _log_queue.put((msg, log_type))
+
+
+def flush_logs():
+    """Waits for the queued log records to be written, then stops the log writer"""
+    global _log_writer
+    with _log_lock:
+        if _log_writer is not None:
+            _log_queue.put(None)
+            _log_writer.join()
+            _log_writer = None
 
 
 def is_archive(file_path):
@@ -239,6 +372,7 @@ def is_archive(file_path):
         return False
 
     # Check the MIME type of the file
+    import mimetypes
     mime_type, _ = mimetypes.guess_type(file_path)
 
     # Common MIME types for archives
@@ -250,86 +384,13 @@ def is_archive(file_path):
         "application/x-7z-compressed",
         "application/x-rar-compressed",
         "application/x-xz",
+        "application/zstd",
     ]
 
     # Return True if the MIME type matches known archive types
     return mime_type in archive_mime_types
 
 
-def get_files(path, rules, options):
-    """Lists the files contained in a given folder
-    :param path: String referring to the path that needs its content to be listed
-    :param rules: List of rules containing exclusions
-    :param options: dictionary/object containing exclusion options
-    :return: A list of files, without any possible node_modules folder
-    """
-    exclusions = {
-        "files": set(),
-        "folders": set(),
-        "dep_folders": set()
-    }
-
-    # Handle nogit option
-    if options['nogit']:
-        rules.append(
-            {
-                "actions": {
-                    "exclude": {
-                        "files": ['.git'],
-                        "folders": ['.gitignore']
-                    }
-                }
-            }
-        )
-
-    # Collect exclusions from all rules
-    for rule in rules:
-        if 'actions' in rule and 'exclude' in rule['actions']:
-            exclude = rule['actions']['exclude']
-            if 'files' in exclude:
-                exclusions['files'].update(exclude['files'])
-            if 'folders' in exclude:
-                exclusions['folders'].update(exclude['folders'])
-            if 'dep_folders' in exclude:
-                exclusions['dep_folders'].update(exclude['dep_folders'])
-
-    # If the noexcl option is set to True, we return all the files in the folder except the dependency folder
-    if options['noexcl']:
-        return [
-            file for file in os.listdir(path)
-            if (exclusions['dep_folders'] and file not in exclusions['dep_folders'])
-            or not exclusions['dep_folders']
-        ]
-
-    elem_list = []
-    for elem in os.listdir(path):
-        excl_matched = False
-        elem_path = os.path.join(path, elem)
-
-        if any(dep_folder in elem_path for dep_folder in exclusions['dep_folders']):
-            excl_matched = True
-        if any(excl in elem_path for excl in exclusions['folders']):
-            excl_matched = True
-        if any(excl in elem_path for excl in exclusions['files']):
-            excl_matched = True
-
-        if not excl_matched:
-            if (
-                not options['keephidden'] and
-                elem.startswith('.') and
-                not (
-                    elem == '.git' or
-                    elem == '.gitignore'
-                )
-            ):
-                excl_matched = True
-
-        if not excl_matched:
-            elem_list.append(elem)
-
-    return elem_list
-
-
 def get_dependency_folders(rules):
     dep_folders = set()
     for rule in rules:
@@ -362,6 +423,7 @@ def req_installed(setup_folder):
     :param setup_folder: str representing the setup folder
     :return: True if it worked, else False
     """
+    import subprocess
     #try:
     venv_bin = f'{setup_folder}/venv/bin/'
     pip_path = f'{venv_bin}pip'
@@ -392,3 +454,30 @@ def req_installed(setup_folder):
     except Exception as e:
         print(f"An error occurred: {e}")
         return False
+
+
+def profile_startup(args):
+    """Runs shlerp with -X importtime to measure its startup
+    :param args: list of arguments passed to main.py
+    :return: the total startup time in seconds, and a list of (module, seconds) tuples holding the cumulated import time
+    of each module imported by main.py (and its own startup by the interpreter), the slowest first
+    """
+    import subprocess
+    started = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', f'{get_setup_fld()}/main.py', *args],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True
+    )
+    total = time.perf_counter() - started
+    modules = []
+    for line in process.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package, indented by its import depth
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line.split('|')
+        if not cumulative.strip().isdigit() or name[1:2] == ' ':
+            continue
+        modules.append((name.strip(), int(cumulative) / 1000000))
+    return total, sorted(modules, key=lambda module: module[1], reverse=True)